@@ -0,0 +1,131 @@
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+
+import aiohttp
+from dotenv import load_dotenv
+from yarl import URL
+
+from metrics import api_circuit_state, api_request_seconds, api_responses_total, api_retries_total
+from resilience import RETRY_STATUSES, CircuitBreaker, RetryPolicy
+from tracing import add_span
+
+load_dotenv()
+
+BASE_URL = os.getenv('NZ_API_URL', 'http://api-mobile.nz.ua/v1/')
+# Опрос уведомлений идёт постоянно и для тысяч пользователей, поэтому ждать его
+# дольше нескольких секунд бессмысленно; остальные эндпоинты берут общий таймаут
+ENDPOINT_TIMEOUTS = {
+    'notifications/last-notifications': 10,
+    'user/login': 15,
+}
+
+
+class NZClient:
+    def __init__(self, base_url: str = BASE_URL, limit: int = 100, limit_per_host: int = 50,
+                 dns_ttl: int = 300, keepalive: float = 30, timeout: float = 30,
+                 timeouts: dict[str, float] | None = None, retry: RetryPolicy | None = None,
+                 breaker: CircuitBreaker | None = None):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive = keepalive
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, 10))
+        self.timeouts = {
+            endpoint: aiohttp.ClientTimeout(total=value, connect=min(value, 10))
+            for endpoint, value in (timeouts or {}).items()
+        }
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker('NZ API')
+        self.base_path = URL(self.base_url).path
+        self._session: aiohttp.ClientSession | None = None
+
+    def _observe(self, context: SimpleNamespace, url: URL, status):
+        path = url.path
+        endpoint = path[len(self.base_path):] if path.startswith(self.base_path) else path
+        duration = time.perf_counter() - context.started
+        api_request_seconds.observe(duration, endpoint=endpoint)
+        add_span('nz_api', duration)
+        api_responses_total.inc(endpoint=endpoint, status=status)
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        async def on_request_start(session, context, params):
+            context.started = time.perf_counter()
+
+        async def on_request_end(session, context, params):
+            self._observe(context, params.url, params.response.status)
+
+        async def on_request_exception(session, context, params):
+            self._observe(context, params.url, 'error')
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Сессия создаётся лениво, уже внутри работающего event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                use_dns_cache=True,
+                keepalive_timeout=self.keepalive,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                                  trace_configs=[self._trace_config()])
+        return self._session
+
+    def url(self, endpoint: str) -> str:
+        return self.base_url + endpoint.lstrip('/')
+
+    async def request(self, method: str, endpoint: str, session: aiohttp.ClientSession | None = None,
+                      **kwargs) -> tuple[int, bytes]:
+        session = session or self.session
+        timeout = self.timeouts.get(endpoint, self.timeout)
+        for attempt in range(self.retry.attempts):
+            self.breaker.before_call()
+            try:
+                async with session.request(method, self.url(endpoint), timeout=timeout, **kwargs) as response:
+                    status, body = response.status, await response.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self.breaker.record_failure()
+                if attempt + 1 == self.retry.attempts:
+                    raise
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                if status not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    return status, body
+                self.breaker.record_failure()
+                if attempt + 1 == self.retry.attempts:
+                    return status, body
+            api_retries_total.inc(endpoint=endpoint)
+            await asyncio.sleep(self.retry.delay(attempt))
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+nz_client = NZClient(
+    limit=int(os.getenv('NZ_API_CONNECTIONS', 100)),
+    limit_per_host=int(os.getenv('NZ_API_CONNECTIONS_PER_HOST', 50)),
+    timeout=float(os.getenv('NZ_API_TIMEOUT', 30)),
+    timeouts=ENDPOINT_TIMEOUTS,
+    retry=RetryPolicy(attempts=int(os.getenv('NZ_API_RETRIES', 3))),
+    breaker=CircuitBreaker(
+        'NZ API',
+        failure_threshold=int(os.getenv('NZ_BREAKER_THRESHOLD', 10)),
+        reset_timeout=float(os.getenv('NZ_BREAKER_RESET', 30)),
+    ),
+)
+api_circuit_state.set_function(nz_client.breaker.state_value)
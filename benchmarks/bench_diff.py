@@ -0,0 +1,62 @@
+import random
+import time
+
+from grades import diff_grades
+
+
+def legacy_compare(previous_lessons, current_grades):
+    changes = {"new_grades": [], "updated_grades": [], "deleted_grades": []}
+    previous_lesson_ids = {lesson['lesson_id'] for lesson in previous_lessons}
+    current_lesson_ids = {lesson['lesson_id'] for lesson in current_grades}
+    for lesson_id in previous_lesson_ids - current_lesson_ids:
+        deleted_lesson = next((item for item in previous_lessons if item["lesson_id"] == lesson_id), None)
+        if deleted_lesson:
+            changes["deleted_grades"].append(deleted_lesson)
+    for grade in current_grades:
+        previous_grade = next((item for item in previous_lessons if item["lesson_id"] == grade["lesson_id"]), None)
+        if previous_grade:
+            if any(grade[key] != previous_grade[key] for key in grade if key != 'lesson_id'):
+                changes["updated_grades"].append({"new": grade, "old": previous_grade})
+        else:
+            changes["new_grades"].append(grade)
+    return changes
+
+
+def make_grades(count: int, churn: float = 0.05):
+    previous = [{
+        'lesson_id': i,
+        'subject': f'Предмет {i % 15}',
+        'lesson_date': f'2024-10-{i % 28 + 1:02d}',
+        'mark': str(random.randint(1, 12)),
+        'lesson_type': 'Поточна',
+        'comment': '',
+    } for i in range(count)]
+    current = [dict(grade) for grade in previous[int(count * churn):]]
+    for grade in random.sample(current, int(count * churn)):
+        grade['mark'] = str(random.randint(1, 12))
+    current += [dict(previous[0], lesson_id=count + i) for i in range(int(count * churn))]
+    return previous, current
+
+
+def measure(func, previous, current, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(previous, current)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    random.seed(0)
+    print(f"{'оценок':>8} | {'diff_grades':>12} | {'нс/оценка':>10} | {'legacy':>10}")
+    for count in (1_000, 2_000, 5_000, 10_000):
+        previous, current = make_grades(count)
+        assert diff_grades(previous, current).as_dict()['new_grades'] == legacy_compare(previous, current)['new_grades']
+        indexed = measure(diff_grades, previous, current, repeat=20)
+        legacy = measure(legacy_compare, previous, current, repeat=1) if count <= 5_000 else float('nan')
+        print(f"{count:>8} | {indexed * 1000:>10.2f}мс | {indexed / count * 1e9:>10.0f} | {legacy * 1000:>8.1f}мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import tempfile
+import time
+
+from benchmarks.mock_api import MockConfig, start_mock_api
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def seed_users(database, count: int):
+    expires = int(time.time()) + 30 * 86400
+    rows = [{
+        'id': user_id,
+        'FIO': f'Учень {user_id}',
+        'token_expired': expires,
+        'student_id': user_id,
+        'login': f'user-{user_id}',
+        'password': 'password',
+        'headers': {**database.User.headers.default, 'authorization': f'Bearer tok-{user_id}'},
+    } for user_id in range(1, count + 1)]
+    with database.db.atomic():
+        for start in range(0, len(rows), 500):
+            database.User.insert_many(rows[start:start + 500]).execute()
+
+
+async def run(args):
+    port = free_port()
+    os.environ['NZ_API_URL'] = f'http://127.0.0.1:{port}/v1/'
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+    # Модули читают окружение при импорте, поэтому импортируются только здесь
+    import database
+    from api import nz_client
+    from poller import GradePoller, PollSchedule
+    from ratelimit import TokenBucket
+
+    database.create_tables()
+    seed_users(database, args.users)
+
+    writes = 0
+    commits = 0
+    execute_sql = database.db.execute_sql
+    commit = database.db.commit
+
+    def counting_execute_sql(sql, *a, **kw):
+        nonlocal writes, commits
+        if sql.lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE')):
+            writes += 1
+            # Вне транзакции каждый запрос записи — отдельный коммит
+            if not database.db.in_transaction():
+                commits += 1
+        return execute_sql(sql, *a, **kw)
+
+    def counting_commit():
+        nonlocal commits
+        commits += 1
+        return commit()
+
+    database.db.execute_sql = counting_execute_sql
+    database.db.commit = counting_commit
+
+    config = MockConfig(latency=args.latency, error_rate=args.error_rate, churn=args.churn)
+    runner, _ = await start_mock_api(config, port=port)
+
+    latencies: list[float] = []
+    polled = changed = 0
+
+    async def poll(user):
+        nonlocal polled, changed
+        started = time.perf_counter()
+        try:
+            changes = await user.get_new_grades()
+            changed += bool(changes)
+            return changes
+        finally:
+            polled += 1
+            latencies.append(time.perf_counter() - started)
+
+    # Тот же путь, что и в боте (background_task): расписание, общий лимит и воркеры,
+    # только интервалы опроса одинаковые и короткие, чтобы прогон укладывался в --duration
+    interval = args.interval
+    schedule = PollSchedule(school=interval, evening=interval, weekend=interval, night=interval,
+                            recent=interval, inactive_factor=1, max_interval=interval)
+    poller = GradePoller(poll, workers=args.workers, circuit=nz_client.breaker,
+                         flush_writes=database.user_writes.flush, refresh_user=database.User.refresh_credentials)
+    flusher = asyncio.create_task(database.user_writes.run())
+    task = asyncio.create_task(poller.run_scheduled(schedule, database.User.active, TokenBucket(args.rate),
+                                                    sync_interval=args.duration + 1))
+    try:
+        print(f"{'время':>6} | {'опрошено':>8} | {'польз/с':>8} | {'p50':>7} | {'p99':>7} "
+              f"| {'изменений':>9} | {'записей':>7} | {'коммитов':>8} | {'запросов':>8}")
+        started = time.perf_counter()
+        while time.perf_counter() - started < args.duration:
+            latencies.clear()
+            polled = changed = writes = commits = 0
+            requests_before = sum(config.requests.values())
+            await asyncio.sleep(args.report)
+            print(
+                f'{time.perf_counter() - started:>5.0f}с | {polled:>8} | {polled / args.report:>8.1f} '
+                f'| {percentile(latencies, 0.5) * 1000:>5.0f}мс | {percentile(latencies, 0.99) * 1000:>5.0f}мс '
+                f'| {changed:>9} | {writes:>7} | {commits:>8} | {sum(config.requests.values()) - requests_before:>8}'
+            )
+    finally:
+        task.cancel()
+        flusher.cancel()
+        await asyncio.gather(task, flusher, return_exceptions=True)
+        await database.user_writes.flush()
+        await nz_client.close()
+        await runner.cleanup()
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'Пиковая память процесса: {max_rss:.0f} МБ')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сквозной бенчмарк опроса оценок на локальной заглушке NZ API')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30, help='Длительность прогона, с')
+    parser.add_argument('--report', type=float, default=5, help='Интервал строк отчёта, с')
+    parser.add_argument('--interval', type=float, default=10, help='Интервал опроса одного пользователя, с')
+    parser.add_argument('--rate', type=float, default=1000, help='Общий лимит опросов в секунду (POLL_RATE)')
+    parser.add_argument('--workers', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--churn', type=float, default=0.05)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
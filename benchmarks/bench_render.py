@@ -0,0 +1,47 @@
+import asyncio
+import random
+import time
+
+import render
+from database import User
+from grades import build_matrix
+
+
+def make_mig(subjects: int = 12, marks: int = 8) -> dict:
+    grades = [
+        {'lesson_id': i * marks + j, 'subject': f'Предмет {i}', 'lesson_date': f'2024-10-{day:02d}',
+         'mark': str(random.randint(1, 12))}
+        for i in range(subjects)
+        for j, day in enumerate(random.sample(range(1, 29), marks))
+    ]
+    return build_matrix(grades, '2024-10')
+
+
+def bench_sync(name: str, func, count: int):
+    started = time.perf_counter()
+    for _ in range(count):
+        func()
+    elapsed = time.perf_counter() - started
+    print(f'{name:<28} {count / elapsed:>8.1f} рендеров/с  ({elapsed / count * 1000:.1f}мс на рендер)')
+
+
+async def bench_pool(count: int, mig: dict):
+    await render.render_performance('Иванов Иван', mig)  # прогрев воркеров
+    started = time.perf_counter()
+    await asyncio.gather(*(render.render_performance('Иванов Иван', mig) for _ in range(count)))
+    elapsed = time.perf_counter() - started
+    print(f'{"Pillow, пул процессов":<28} {count / elapsed:>8.1f} рендеров/с')
+    render.shutdown()
+
+
+def main():
+    random.seed(0)
+    mig = make_mig()
+    user = User(id=1, FIO='Иванов Иван', mig=mig)
+    bench_sync('matplotlib (generate_image)', user.generate_image, 10)
+    bench_sync('Pillow (render_table)', lambda: render.render_table('Иванов Иван', mig), 50)
+    asyncio.run(bench_pool(100, mig))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# Выполняется в отдельном процессе, чтобы мерить холодный импорт
+PROBE = r'''
+import asyncio, json, resource, sys, time
+started = time.perf_counter()
+import main
+import_time = time.perf_counter() - started
+heavy = sorted(name for name in ('pandas', 'numpy', 'matplotlib', 'PIL') if name in sys.modules)
+
+from datetime import datetime
+from aiogram.types import Chat, Message, Update, User
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+
+class FakeTelegram(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        return Message(message_id=2, date=datetime.now(), chat=Chat(id=1, type='private'), text='ok')
+
+
+async def first_update():
+    await main.db_call(main.create_tables)
+    main.bot.session.middleware(FakeTelegram())
+    update = Update(update_id=1, message=Message(
+        message_id=1, date=datetime.now(), chat=Chat(id=1, type='private'),
+        from_user=User(id=1, is_bot=False, first_name='bench'), text='/start'))
+    started = time.perf_counter()
+    await main.dp.feed_update(main.bot, update)
+    latency = time.perf_counter() - started
+    await main.bot.session.close()
+    return latency
+
+
+latency = asyncio.run(first_update())
+print(json.dumps({
+    'import': import_time,
+    'first_update': latency,
+    'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'heavy': heavy,
+}))
+'''
+
+
+def run_probe(env: dict) -> dict:
+    output = subprocess.run([sys.executable, '-c', PROBE], env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main(runs: int = 5):
+    env = {**os.environ, 'TOKEN': os.getenv('TOKEN', '1:bench'), 'PYTHONPATH': os.getcwd(),
+           'DATABASE_PATH': os.path.join(tempfile.mkdtemp(), 'startup.db')}
+    results = [run_probe(env) for _ in range(runs)]
+    best = min(results, key=lambda result: result['import'])
+    print(f"Импорт main:          {best['import'] * 1000:.0f}мс (лучший из {runs})")
+    print(f"Первый апдейт /start: {min(r['first_update'] for r in results) * 1000:.1f}мс")
+    print(f"Пиковый RSS:          {best['rss_mb']:.0f} МБ")
+    print(f"Тяжёлые модули при старте: {', '.join(best['heavy']) or 'нет'}")
+
+
+if __name__ == '__main__':
+    main()
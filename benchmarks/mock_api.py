@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+SUBJECTS = ['Алгебра', 'Геометрія', 'Українська мова', 'Англійська мова', 'Фізика',
+            'Хімія', 'Біологія', 'Історія України', 'Географія', 'Інформатика']
+
+
+@dataclass
+class MockConfig:
+    latency: float = 0.05
+    jitter: float = 0.02
+    error_rate: float = 0.0
+    churn: float = 0.05
+    requests: dict = field(default_factory=dict)
+
+
+class MockNZApi:
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.notifications: dict[int, list[dict]] = {}
+        self._next_id = 1
+
+    def _user_id(self, request: web.Request) -> int:
+        return int(request.headers.get('authorization', 'Bearer tok-0').rsplit('-', 1)[-1])
+
+    def _notification(self) -> dict:
+        self._next_id += 1
+        return {
+            'id': self._next_id,
+            'sentAt': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'data': {
+                'type': 'add-mark',
+                'lessonName': random.choice(SUBJECTS),
+                'markValue': str(random.randint(1, 12)),
+                'lessonType': 'Поточна',
+                'comment': '',
+            },
+        }
+
+    async def _simulate(self, name: str):
+        self.config.requests[name] = self.config.requests.get(name, 0) + 1
+        delay = max(random.gauss(self.config.latency, self.config.jitter), 0)
+        await asyncio.sleep(delay)
+        if random.random() < self.config.error_rate:
+            raise web.HTTPInternalServerError()
+
+    async def login(self, request: web.Request) -> web.Response:
+        await self._simulate('login')
+        payload = await request.json()
+        user_id = int(str(payload['username']).rsplit('-', 1)[-1])
+        return web.json_response({
+            'FIO': f'Учень {user_id}',
+            'expires_token': int(time.time() + timedelta(days=30).total_seconds()),
+            'student_id': user_id,
+            'access_token': f'tok-{user_id}',
+        })
+
+    async def last_notifications(self, request: web.Request) -> web.Response:
+        await self._simulate('last-notifications')
+        limit = int(request.query.get('limit', 20))
+        items = self.notifications.setdefault(self._user_id(request), [])
+        if not items or random.random() < self.config.churn:
+            items.insert(0, self._notification())
+            del items[400:]
+        return web.json_response({'data': items[:limit]})
+
+    async def schedule(self, request: web.Request) -> web.Response:
+        endpoint = request.match_info['endpoint']
+        await self._simulate(endpoint)
+        payload = await request.json()
+        start = datetime.strptime(payload['start_date'], '%Y-%m-%d')
+        end = datetime.strptime(payload['end_date'], '%Y-%m-%d')
+        days = [(start + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((end - start).days + 1)]
+
+        if endpoint == 'student-performance':
+            return web.json_response({
+                'subjects': [
+                    {'subject_id': i, 'subject_name': name,
+                     'marks': [str(random.randint(1, 12)) for _ in range(random.randint(0, 6))]}
+                    for i, name in enumerate(SUBJECTS)
+                ],
+                'missed': {'days': random.randint(0, 3), 'lessons': random.randint(0, 10)},
+            })
+        if endpoint == 'missed-lessons':
+            return web.json_response({'missed_lessons': []})
+        if endpoint == 'subject-grades':
+            return web.json_response({'lessons': [
+                {'lesson_date': day, 'mark': str(random.randint(1, 12)), 'type': 'Поточна', 'comment': ''}
+                for day in days[:5]
+            ]})
+
+        return web.json_response({'dates': [{
+            'date': day,
+            'calls': [{
+                'call_number': number,
+                'subjects': [{
+                    'subject_name': SUBJECTS[(number + i) % len(SUBJECTS)],
+                    'teacher': {'name': 'Вчитель'},
+                    'lesson': [{'type': 'Поточна', 'mark': '', 'comment': ''}],
+                    'hometask': ['§1, вправа 2'],
+                }],
+            } for number in range(1, 7)],
+        } for i, day in enumerate(days)]})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v1/user/login', self.login)
+        app.router.add_get('/v1/notifications/last-notifications', self.last_notifications)
+        app.router.add_post('/v1/schedule/{endpoint}', self.schedule)
+        return app
+
+
+async def start_mock_api(config: MockConfig, host: str = '127.0.0.1', port: int = 0) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(MockNZApi(config).app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://{host}:{port}/v1/'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальная заглушка api-mobile.nz.ua')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--churn', type=float, default=0.05)
+    args = parser.parse_args()
+
+    config = MockConfig(latency=args.latency, error_rate=args.error_rate, churn=args.churn)
+    web.run_app(MockNZApi(config).app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from benchmarks.bench_poller import percentile
+
+
+def load_updates(path: str) -> list[dict]:
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+async def replay(args):
+    updates = load_updates(args.updates)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+
+    async def post(session: aiohttp.ClientSession, update_id: int, update: dict):
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(args.url, json={**update, 'update_id': update_id}, headers=headers) as response:
+                await response.read()
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(
+            post(session, args.first_id + i, updates[i % len(updates)])
+            for i in range(args.count or len(updates))
+        ))
+    elapsed = time.perf_counter() - started
+
+    print(f'Отправлено {len(latencies)} апдейтов за {elapsed:.2f}с ({len(latencies) / elapsed:.0f}/с)')
+    print(f'p50 {percentile(latencies, 0.5) * 1000:.1f}мс | p99 {percentile(latencies, 0.99) * 1000:.1f}мс | коды {statuses}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Отправка записанных апдейтов на локальный вебхук бота')
+    parser.add_argument('updates', help='Файл JSON Lines, по одному объекту Update на строку')
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    parser.add_argument('--secret', default=None)
+    parser.add_argument('--count', type=int, default=0, help='Сколько апдейтов отправить (по кругу)')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--first-id', type=int, default=1)
+    asyncio.run(replay(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
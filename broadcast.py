@@ -0,0 +1,63 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Hashable
+
+from logger import logging
+
+
+@dataclass
+class BroadcastStats:
+    users: int = 0
+    fetched: int = 0
+    failed: int = 0
+    enqueued: int = 0
+    fetch_duration: float = 0.0
+    delivery_duration: float = 0.0
+
+
+class Broadcast:
+    def __init__(self, concurrency: int = 10):
+        self.concurrency = concurrency
+        # Задача предзагрузки хранится, пока её не заберёт рассылка: если к началу
+        # рассылки она ещё идёт, рассылка дожидается её, а не запускает вторую
+        self._prefetches: dict[Hashable, asyncio.Task] = {}
+
+    async def prefetch(self, key: Hashable, users: list, fetch: Callable[[Any], Awaitable[Any]]) -> BroadcastStats:
+        task = self._prefetches.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch_all(key, users, fetch))
+            self._prefetches = {key: task}
+        _, stats = await asyncio.shield(task)
+        return stats
+
+    async def _fetch_all(self, key: Hashable, users: list,
+                         fetch: Callable[[Any], Awaitable[Any]]) -> tuple[list, BroadcastStats]:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        stats = BroadcastStats(users=len(users))
+
+        async def fetch_one(user):
+            async with semaphore:
+                try:
+                    result = await fetch(user)
+                    stats.fetched += 1
+                    return user, result
+                except Exception as e:
+                    stats.failed += 1
+                    logging.error(f'{user.id} | Ошибка предзагрузки рассылки: {e}')
+                    return user, e
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(fetch_one(user) for user in users))
+        stats.fetch_duration = time.perf_counter() - started
+        logging.info(
+            f'Предзагрузка рассылки {key}: {stats.fetched}/{stats.users} за {stats.fetch_duration:.1f}с '
+            f'| ошибок: {stats.failed}'
+        )
+        return results, stats
+
+    async def take(self, key: Hashable) -> tuple[list, BroadcastStats] | None:
+        task = self._prefetches.pop(key, None)
+        if task is None:
+            return None
+        return await task
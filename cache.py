@@ -0,0 +1,91 @@
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+from logger import logging
+
+
+class _Entry:
+    __slots__ = ('value', 'size', 'fetched_at')
+
+    def __init__(self, value: Any, size: int):
+        self.value = value
+        self.size = size
+        self.fetched_at = time.monotonic()
+
+
+class ResponseCache:
+    def __init__(self, policies: dict[str, tuple[float, float]], max_bytes: int = 32 * 1024 * 1024):
+        # policies: endpoint -> (ttl, stale), где stale — сколько ещё секунд после ttl
+        # можно отдавать старый ответ, обновляя его в фоне
+        self.policies = policies
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get_or_fetch(self, key: Hashable, endpoint: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        policy = self.policies.get(endpoint)
+        if policy is None:
+            return await fetch()
+        ttl, stale = policy
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry.fetched_at
+            if age < ttl + stale:
+                self._entries.move_to_end(key)
+                if age >= ttl and key not in self._inflight:
+                    self._load(key, fetch).add_done_callback(self._log_refresh_error)
+                return entry.value
+
+        task = self._inflight.get(key) or self._load(key, fetch)
+        return await asyncio.shield(task)
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]):
+        for key in [key for key in self._entries if predicate(key)]:
+            self.size -= self._entries.pop(key).size
+
+    def _load(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        async def load():
+            value = await fetch()
+            self._store(key, value)
+            return value
+
+        task = asyncio.ensure_future(load())
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+
+    def _store(self, key: Hashable, value: Any):
+        if value is None:
+            return
+        size = len(json.dumps(value, ensure_ascii=False))
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old.size
+        self._entries[key] = _Entry(value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.size
+
+    @staticmethod
+    def _log_refresh_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning(f'Не удалось обновить кэш в фоне: {task.exception()}')
+
+
+response_cache = ResponseCache({
+    'schedule/diary': (300, 1800),
+    'schedule/student-performance': (600, 3600),
+    'schedule/missed-lessons': (1800, 3600),
+}, max_bytes=int(os.getenv('CACHE_MAX_BYTES', 32 * 1024 * 1024)))
@@ -1,20 +1,143 @@
+import asyncio
+import functools
+import hashlib
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import aiohttp
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
 from peewee import (
-    Model, CharField, IntegerField,
-    ForeignKeyField, TextField, AutoField, Field
+    Model, CharField, IntegerField, FloatField, BooleanField, DateField,
+    ForeignKeyField, TextField, AutoField, Field, fn
 )
+from playhouse.migrate import SqliteMigrator, migrate
 from playhouse.sqlite_ext import SqliteExtDatabase
 from logger import logging
-import io
+from api import nz_client
+from cache import response_cache
+from grades import GradeChanges, diff_grades, update_matrix
+from resilience import CircuitOpenError
+from tokens import token_manager
+from tracing import span
+
+
+db = SqliteExtDatabase(os.getenv('DATABASE_PATH', 'database.db'), pragmas={
+    'foreign_keys': 1,
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64 * 1024,
+    'temp_store': 'memory',
+    'busy_timeout': 5000,
+})
+
+NOTIFICATIONS_LIMIT = 20
+TIMETABLE_MAX_AGE = int(os.getenv('TIMETABLE_MAX_AGE', 24 * 3600))
+NOTIFICATIONS_MAX_LIMIT = 320
+
+# Все запросы из асинхронного кода выполняются в одном выделенном потоке:
+# SQLite всё равно сериализует запись, а event loop не блокируется
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+
+async def db_call(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    with span('db'):
+        return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+
+class WriteBuffer:
+    # Изменения из опроса копятся и пишутся одной транзакцией: в WAL это один
+    # коммит и один fsync на пачку вместо одного на каждого пользователя
+    def __init__(self, max_pending: int = 500, interval: float = 1.0, max_attempts: int = 3):
+        self.max_pending = max_pending
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self._pending: dict[tuple, Model] = {}
+        self._calls: list[tuple] = []
+        self._since = 0.0
+
+    def __len__(self) -> int:
+        return len(self._pending) + len(self._calls)
+
+    def _touch(self):
+        if not len(self):
+            self._since = time.monotonic()
+
+    def add(self, instance: Model):
+        self._touch()
+        self._pending[(type(instance), instance._pk)] = instance
+
+    def defer(self, func, *args):
+        # Произвольная запись (например, вставка строк) в той же транзакции, что и пачка
+        self._touch()
+        self._calls.append((func, args, 0))
+
+    def due(self) -> bool:
+        return bool(len(self)) and (len(self) >= self.max_pending
+                                    or time.monotonic() - self._since >= self.interval)
+
+    async def flush(self) -> int:
+        pending, self._pending = self._pending, {}
+        calls, self._calls = self._calls, []
+        # Значения снимаются здесь, в потоке event loop: пока пачка пишется,
+        # объекты могут снова измениться, и эти изменения уйдут следующей пачкой
+        updates = []
+        for instance in pending.values():
+            fields = instance.dirty_fields
+            if fields:
+                updates.append((instance, {field: instance.__data__.get(field.name) for field in fields}))
+                instance._dirty.clear()
+        if not updates and not calls:
+            return 0
+        try:
+            failed = await db_call(self._write, updates, calls)
+        except Exception as e:
+            # Пачка целиком не записалась (например, database is locked) — обновления
+            # повторятся со следующей, отложенные вызовы — не больше max_attempts раз
+            logging.error(f'Не удалось записать пачку из {len(updates) + len(calls)} изменений: {e}')
+            for instance, values in updates:
+                instance._dirty.update(field.name for field in values)
+                self.add(instance)
+            failed = [(call, e) for call in calls]
+        self._retry(failed)
+        return len(updates) + len(calls) - len(failed)
+
+    def _retry(self, failed: list):
+        for (func, args, attempts), error in failed:
+            if attempts + 1 >= self.max_attempts:
+                logging.error(f'Отложенная запись {func.__name__} отброшена после {attempts + 1} попыток: {error}')
+            else:
+                self._touch()
+                self._calls.append((func, args, attempts + 1))
+
+    @staticmethod
+    def _write(updates: list, calls: list) -> list:
+        failed = []
+        with db.atomic():
+            for call in calls:
+                func, args, _ = call
+                # Каждый вызов в своей точке сохранения: ошибка одного не откатывает пачку
+                try:
+                    with db.atomic():
+                        func(*args)
+                except Exception as e:
+                    failed.append((call, e))
+            for instance, values in updates:
+                model = type(instance)
+                model.update(values).where(model._meta.primary_key == instance._pk).execute()
+        return failed
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if len(self):
+                await self.flush()
 
 
-db = SqliteExtDatabase('database.db', pragmas={'foreign_keys': 1})
+user_writes = WriteBuffer(max_pending=int(os.getenv('DB_BATCH_SIZE', 500)),
+                          interval=float(os.getenv('DB_BATCH_INTERVAL', 1.0)))
 
 
 class JSONField(TextField):
@@ -29,6 +152,11 @@ class JSONField(TextField):
         return '{}'
 
 
+# Поля, которые может поменять бот (повторная авторизация). Состояние опроса
+# (last_marks, курсор уведомлений, mig) принадлежит поллеру и из БД не перечитывается
+CREDENTIAL_FIELDS = ('FIO', 'token_expired', 'student_id', 'login', 'password', 'headers')
+
+
 class User(Model):
     id = IntegerField(primary_key=True, unique=True)
     FIO = CharField(null=True)
@@ -38,6 +166,10 @@ class User(Model):
     password = CharField(null=True)
     last_marks = JSONField(default={})
     mig = JSONField(default={})
+    notifications_cursor = IntegerField(null=True)
+    notifications_digest = CharField(null=True)
+    # С какой даты в таблице Grade нет пропусков: всё, что новее, бот видел в уведомлениях
+    grades_since = CharField(null=True)
     headers = JSONField(default={
         'accept': "*/*",
         'content-type': "application/json",
@@ -48,37 +180,75 @@ class User(Model):
 
     class Meta:
         database = db
+        # UPDATE пишет только изменённые поля, а не все JSON-колонки разом.
+        # JSON-поля нужно присваивать заново: изменения на месте не отслеживаются
+        only_save_dirty = True
+
+    @classmethod
+    async def aget(cls, user_id: int) -> 'User | None':
+        return await db_call(cls.get_or_none, id=user_id)
+
+    @classmethod
+    async def acreate(cls, **kwargs) -> 'User':
+        return await db_call(cls.create, **kwargs)
+
+    @classmethod
+    async def active(cls, shard_count: int | None = None, shards=None) -> list['User']:
+        query = cls.select().where(cls.token_expired != None)
+        if shard_count:
+            query = query.where((cls.id % shard_count).in_(list(shards or [])))
+        return await db_call(lambda: list(query))
+
+    async def asave(self, *args, **kwargs):
+        return await db_call(self.save, *args, **kwargs)
 
-    async def __login(self, session: aiohttp.ClientSession) -> dict | None:
-        url = "http://api-mobile.nz.ua/v1/user/login"
+    def save_later(self):
+        user_writes.add(self)
+
+    def refresh_credentials(self, fresh: 'User'):
+        # Пишется прямо в __data__, чтобы поля не стали грязными и не ушли обратно в БД
+        for name in CREDENTIAL_FIELDS:
+            if name not in self._dirty:
+                self.__data__[name] = fresh.__data__.get(name)
+
+    async def adelete(self):
+        return await db_call(self.delete_instance)
+
+    async def __login(self, session: aiohttp.ClientSession | None = None) -> dict:
         payload = {
             "username": self.login,
             "password": self.password
         }
 
-        async with session.post(url, json=payload, headers=self.headers) as response:
-            if response.status == 200:
-                data = await response.json()
-                self.FIO = data['FIO']
-                self.token_expired = data['expires_token']
-                self.student_id = data['student_id']
-                self.headers['authorization'] = f"Bearer {data['access_token']}"
-                self.save()
-                return data
-            else:
-                raise Exception(f'Произошла ошибка авторизации {response.status}')
-
-    async def credentials(self, login: str, password: str, session: aiohttp.ClientSession):
+        status, body = await nz_client.request('POST', 'user/login', session, json=payload, headers=self.headers)
+        if status == 200:
+            return json.loads(body)
+        else:
+            raise Exception(f'Произошла ошибка авторизации {status}')
+
+    async def _refresh_token(self, session: aiohttp.ClientSession | None = None) -> dict:
+        # Параллельные обновления одного аккаунта сводятся в один логин,
+        # результат применяется к каждому экземпляру User
+        data = await token_manager.refresh(self.id, lambda: self.__login(session))
+        self.FIO = data['FIO']
+        self.token_expired = data['expires_token']
+        self.student_id = data['student_id']
+        self.headers = {**self.headers, 'authorization': f"Bearer {data['access_token']}"}
+        await self.asave()
+        token_manager.schedule(self.id, self.token_expired)
+        return data
+
+    async def credentials(self, login: str, password: str, session: aiohttp.ClientSession | None = None):
         self.login, self.password = (login, password)
-        self.save()
-        return await self.__login(session)
+        await self.asave()
+        return await self._refresh_token(session)
 
-    async def _check_token_expire(self, session: aiohttp.ClientSession):
-        month = int(datetime.now().timestamp() + timedelta(days=25).total_seconds())
-        if self.token_expired <= month:
-            await self.__login(session)
+    async def _check_token_expire(self, session: aiohttp.ClientSession | None = None):
+        if token_manager.needs_refresh(self.token_expired):
+            await self._refresh_token(session)
 
-    async def _fetch_data(self, url: str, dates: list, session: aiohttp.ClientSession) -> dict | None:
+    async def _fetch_data(self, endpoint: str, dates: list,
+                          session: aiohttp.ClientSession | None = None) -> dict | None:
         if len(dates) == 1:
             dates.append(dates[0])
         elif len(dates) != 2:
@@ -90,16 +260,49 @@ class User(Model):
             "student_id": self.student_id
         }
 
-        async with session.post(url, headers=self.headers, json=payload) as response:
-            if response.status == 200:
-                return await response.json()
-            else:
-                logging.critical(
-                    f'Произошла ошибка получения {url[27:]} {response.status}')
-                raise Exception(
-                    f'Произошла ошибка получения {url[27:]} {response.status}')
-
-    async def _fetch_grades(self, dates: list, subject: int, session: aiohttp.ClientSession):
+        status, body = await nz_client.request('POST', endpoint, session, headers=self.headers, json=payload)
+        if status == 200:
+            return json.loads(body)
+        else:
+            logging.critical(
+                f'Произошла ошибка получения {endpoint} {status}')
+            raise Exception(
+                f'Произошла ошибка получения {endpoint} {status}')
+
+    async def fetch(self, endpoint: str, dates: list) -> dict | None:
+        dates = (dates[0], dates[-1])
+        return await response_cache.get_or_fetch(
+            (self.student_id, endpoint, dates), endpoint,
+            lambda: self._fetch_data(endpoint, list(dates))
+        )
+
+    async def timetable(self, refresh: bool = False) -> list[dict]:
+        week = week_start(datetime.now())
+        row = await db_call(Timetable.get_or_none, Timetable.user == self.id)
+        current = row is not None and row.week_start == week
+        if current and not refresh and time.time() - row.fetched_at < TIMETABLE_MAX_AGE:
+            return row.days
+        try:
+            return await self.refresh_timetable()
+        except Exception as e:
+            # Расписание внутри недели почти не меняется, поэтому при ошибке
+            # NZ лучше показать сохранённое, чем ничего. Явное обновление
+            # должно узнать об ошибке, а не получить старую копию
+            if not current or refresh:
+                raise
+            logging.warning(f'{self.id} | Расписание из локальной копии: {e}')
+            return row.days
+
+    async def refresh_timetable(self, session: aiohttp.ClientSession | None = None) -> list[dict]:
+        week = week_start(datetime.now())
+        end = datetime.strptime(week, '%Y-%m-%d') + timedelta(days=6)
+        await self._check_token_expire(session)
+        data = await self._fetch_data('schedule/timetable', [week, end.strftime('%Y-%m-%d')], session)
+        days = normalize_timetable(data)
+        await db_call(save_timetable, self.id, week, days)
+        return days
+
+    async def _fetch_grades(self, dates: list, subject: int, session: aiohttp.ClientSession | None = None):
         if len(dates) == 1:
             dates.append(dates[0])
         elif len(dates) != 2:
@@ -110,58 +313,100 @@ class User(Model):
             "start_date": dates[0],
             "end_date": dates[1]
         }
-        async with session.post("http://api-mobile.nz.ua/v1/schedule/subject-grades",
-                               headers=self.headers, json=payload) as grades_response:
-            grades_response.raise_for_status()
-            return await grades_response.json()
-    async def _fetch_new_api_data(self, session: aiohttp.ClientSession):
-        url = 'http://api-mobile.nz.ua/v1/notifications/last-notifications?limit=20'
-        headers = {
-            'Authorization': f'Bearer {self.token}'
-        }
-
-        async with session.get(url, headers=headers) as response:
-            response.raise_for_status()
-            return await response.json()
-
-    async def get_new_grades(self, session: aiohttp.ClientSession):
-        try:
-            await self._check_token_expire(session)
-
-            new_api_response = await self._fetch_new_api_data(session)
+        status, body = await nz_client.request('POST', 'schedule/subject-grades', session,
+                                               headers=self.headers, json=payload)
+        if status != 200:
+            raise Exception(f'Произошла ошибка получения schedule/subject-grades {status}')
+        return json.loads(body)
+
+    async def fetch_subject_grades(self, dates: list, subjects: dict[int, str], concurrency: int = 5,
+                                   session: aiohttp.ClientSession | None = None) -> dict[str, list | Exception]:
+        # Все предметы запрашиваются одновременно (но не больше concurrency сразу),
+        # поэтому отчёт ждёт самый медленный запрос, а не их сумму
+        await self._check_token_expire(session)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_one(subject_id: int):
+            async with semaphore:
+                return await self._fetch_grades(list(dates), subject_id, session)
+
+        results = await asyncio.gather(*(fetch_one(subject_id) for subject_id in subjects), return_exceptions=True)
+        grades = {}
+        for name, result in zip(subjects.values(), results):
+            if isinstance(result, Exception):
+                logging.warning(f'{self.id} | Не удалось получить оценки по предмету {name}: {result}')
+                grades[name] = result
+            else:
+                grades[name] = (result or {}).get('lessons', [])
+        return grades
+
+    async def _fetch_new_api_data(self, session: aiohttp.ClientSession | None = None, limit: int = 20) -> bytes:
+        status, body = await nz_client.request('GET', 'notifications/last-notifications', session,
+                                               params={'limit': limit}, headers=self.headers)
+        if status != 200:
+            raise Exception(f'Произошла ошибка получения notifications/last-notifications {status}')
+        return body
+
+    def _window_overflowed(self, items: list, limit: int) -> bool:
+        # Все уведомления в окне новее курсора — часть новых оценок могла в него не попасть
+        if self.notifications_cursor is None or len(items) < limit:
+            return False
+        return min(int(item['id']) for item in items) > self.notifications_cursor
+
+    @staticmethod
+    def _window_start(items: list, limit: int) -> str:
+        if len(items) < limit:
+            # Окно не заполнено — в нём вся история уведомлений
+            return '0001-01-01'
+        # Оценки за день самого старого уведомления могли остаться за окном
+        oldest = min(datetime.fromisoformat(item['sentAt']) for item in items)
+        return (oldest + timedelta(days=1)).strftime('%Y-%m-%d')
+
+    async def get_new_grades(self, session: aiohttp.ClientSession | None = None) -> GradeChanges:
+        # Ошибки NZ и разбора ответа не глушатся: поллер считает их и пишет в лог с трейсбеком
+        await self._check_token_expire(session)
+
+        limit = NOTIFICATIONS_LIMIT
+        while True:
+            body = await self._fetch_new_api_data(session, limit)
+            digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+            if digest == self.notifications_digest:
+                return GradeChanges()
+
+            new_api_response = json.loads(body)
             if not new_api_response or 'data' not in new_api_response:
-                print("Error: Invalid response from new API")
-                return None
+                raise ValueError('Некорректный ответ notifications/last-notifications')
 
             new_grades_data = new_api_response['data']
+            if limit >= NOTIFICATIONS_MAX_LIMIT or not self._window_overflowed(new_grades_data, limit):
+                break
+            limit *= 2
+
+        all_grades = self._transform_new_api_data(new_grades_data)
+        changes = self._compare_grades(all_grades)
+
+        if self.grades_since is None or self._window_overflowed(new_grades_data, limit):
+            self.grades_since = self._window_start(new_grades_data, limit)
+
+        user_writes.defer(record_grades, self.id, all_grades, changes.deleted_grades)
+        matrix = update_matrix(self.mig, all_grades, changes, datetime.now().strftime('%Y-%m'))
+        if matrix is not None:
+            self.mig = matrix
+        self.last_marks = {"lessons": all_grades}
+        self.notifications_digest = digest
+        if new_grades_data:
+            newest = max(int(item['id']) for item in new_grades_data)
+            self.notifications_cursor = max(self.notifications_cursor or 0, newest)
+        self.save_later()
 
-            all_grades = self._transform_new_api_data(new_grades_data)
-            if all_grades is None:
-                return None
-
-            changes = self._compare_grades(all_grades)
-
-            self.last_marks = {"lessons": all_grades}
-            self.save()
-
-            return changes
-
-        except aiohttp.ClientError as e:
-            print(f"Error during API request: {e}")
-            return None
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON response: {e}")
-            return None
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-            return None
+        return changes
 
     def _transform_new_api_data(self, new_api_data):
         transformed_grades = []
         for item in new_api_data:
             if item['data']['type'] == 'add-mark':
                 try:
-                    lesson_date = datetime.strptime(item['sentAt'], '%Y-%m-%d %H:%M:%S').strftime('%Y-%m-%d')
+                    lesson_date = datetime.fromisoformat(item['sentAt']).strftime('%Y-%m-%d')
                     transformed_grades.append({
                         'lesson_id': item['id'],
                         'subject': item['data']['lessonName'],
@@ -171,57 +416,34 @@ class User(Model):
                         'comment' : item['data']['comment']
                     })
                 except (ValueError, KeyError) as e:
-                    print(f"Error processing new API data item: {item}. Error: {e}")
-                    return None
+                    raise ValueError(f'Некорректное уведомление {item.get("id")}: {e}') from e
         return transformed_grades
 
 
-    def _compare_grades(self, current_grades):
-        changes = {
-            "new_grades": [],
-            "updated_grades": [],
-            "deleted_grades": []
-        }
-
-        previous_lessons = self.last_marks.get("lessons", [])
-        previous_lesson_ids = {lesson['lesson_id'] for lesson in previous_lessons}
-        current_lesson_ids = {lesson['lesson_id'] for lesson in current_grades}
-        deleted_lesson_ids = previous_lesson_ids - current_lesson_ids
-        for lesson_id in deleted_lesson_ids:
-            deleted_lesson = next((item for item in previous_lessons if item["lesson_id"] == lesson_id), None)
-            if deleted_lesson:
-                changes["deleted_grades"].append(deleted_lesson)
-
-        for grade in current_grades:
-            previous_grade = next((item for item in previous_lessons if item["lesson_id"] == grade["lesson_id"]), None)
-
-            if previous_grade:
-                if any(grade[key] != previous_grade[key] for key in grade if key != 'lesson_id'):
-                    changes["updated_grades"].append({"new": grade, "old": previous_grade})
-            else:
-                changes["new_grades"].append(grade)
-
-        return changes
+    def _compare_grades(self, current_grades) -> GradeChanges:
+        previous = self.last_marks.get("lessons", [])
+        if current_grades:
+            # Оценки, выпавшие из окна уведомлений, не считаются удалёнными
+            oldest = min(int(grade['lesson_id']) for grade in current_grades)
+            previous = [grade for grade in previous if int(grade['lesson_id']) >= oldest]
+        return diff_grades(previous, current_grades)
 
     def generate_image(self):
+        # Исходный рендер через pandas/matplotlib, оставлен для сравнения в benchmarks/bench_render.py
+        import io
+
+        import matplotlib.colors as mcolors
+        import matplotlib.pyplot as plt
+        import pandas as pd
 
         try:
 
-            if not self.mig:
+            if not self.mig or not self.mig.get('rows'):
                 logging.warning("No data available to generate table.")
                 return None
 
 
-            dates_for_table = sorted(set(date for subject_data in self.mig.values() for date in subject_data))
-            table_data = []
-            for subject, grades in self.mig.items():
-                row = {'Предмет': subject}
-                for date in dates_for_table:
-                    row[date] = grades.get(date, '')
-                table_data.append(row)
-
-
-            df = pd.DataFrame(table_data).set_index('Предмет')
+            df = pd.DataFrame(self.mig['rows'], index=self.mig['subjects'], columns=self.mig['dates'])
             if df.empty:
                 logging.warning("No subjects found in the data.")
                 return None
@@ -272,11 +494,200 @@ class User(Model):
             return None
 
 
+class Lease(Model):
+    name = CharField(primary_key=True)
+    owner = CharField(null=True)
+    expires_at = FloatField(default=0)
+
+    class Meta:
+        database = db
+
+
+def acquire_lease(name: str, owner: str, ttl: float, grace: float = 0) -> float | None:
+    # Один UPDATE атомарен и между процессами: лиза достаётся либо текущему
+    # владельцу (продление), либо любому, если она истекла больше grace секунд назад.
+    # Возвращает прежний срок лизы (0 — у неё не было владельца) или None, если не досталась
+    now = time.time()
+    with db.atomic():
+        Lease.insert(name=name, expires_at=0).on_conflict_ignore().execute()
+        previous = Lease.select(Lease.expires_at).where(Lease.name == name).scalar()
+        updated = (Lease
+                   .update(owner=owner, expires_at=now + ttl)
+                   .where((Lease.name == name) & ((Lease.owner == owner) | (Lease.expires_at <= now - grace)))
+                   .execute())
+    return previous if updated == 1 else None
+
+
+def lease_owners(prefix: str) -> dict[str, int]:
+    # Живые владельцы лиз с именем на prefix и сколько таких лиз у каждого
+    query = (Lease
+             .select(Lease.owner, fn.COUNT(Lease.name))
+             .where(Lease.name.startswith(prefix) & Lease.owner.is_null(False) & (Lease.expires_at > time.time()))
+             .group_by(Lease.owner)
+             .tuples())
+    return dict(query)
+
+
+def release_lease(name: str, owner: str):
+    Lease.update(owner=None, expires_at=time.time()).where((Lease.name == name) & (Lease.owner == owner)).execute()
+
+
+class Timetable(Model):
+    user = ForeignKeyField(User, primary_key=True, on_delete='CASCADE')
+    week_start = CharField()
+    days = JSONField(default=list)
+    fetched_at = FloatField()
+
+    class Meta:
+        database = db
+
+
+def week_start(day: datetime) -> str:
+    return (day - timedelta(days=day.weekday())).strftime('%Y-%m-%d')
+
+
+def normalize_timetable(data: dict | None) -> list[dict]:
+    # Из ответа NZ остаётся только то, что показывает бот: дата и уроки
+    # в виде [номер, предмет, учитель]
+    days = []
+    for day in (data or {}).get('dates', []):
+        lessons = [
+            [call['call_number'], subject['subject_name'],
+             subject['teacher']['name'] if subject.get('teacher') else None]
+            for call in day.get('calls') or []
+            for subject in call['subjects']
+        ]
+        days.append({'date': day['date'], 'lessons': lessons})
+    return days
+
+
+def save_timetable(user_id: int, week: str, days: list[dict]):
+    (Timetable
+     .insert(user=user_id, week_start=week, days=days, fetched_at=time.time())
+     .on_conflict_replace()
+     .execute())
+
+
+class Grade(Model):
+    user = ForeignKeyField(User, on_delete='CASCADE', backref='grades')
+    notification_id = IntegerField()
+    subject = CharField()
+    lesson_date = DateField()
+    mark = CharField()
+    value = IntegerField(null=True)
+    lesson_type = CharField(null=True)
+    comment = TextField(null=True)
+    removed = BooleanField(default=False)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('user', 'subject', 'lesson_date'), False),
+            (('user', 'notification_id'), True),
+        )
+
+
+def _mark_value(mark) -> int | None:
+    mark = str(mark).strip()
+    return int(mark) if mark.isdigit() else None
+
+
+def record_grades(user_id: int, grades: list[dict], deleted: list[dict]):
+    # Строки только добавляются и исправляются: оценки, выпавшие из окна
+    # уведомлений, остаются в истории
+    if not User.select().where(User.id == user_id).exists():
+        return
+    rows = [{
+        'user': user_id,
+        'notification_id': int(grade['lesson_id']),
+        'subject': grade['subject'],
+        'lesson_date': grade['lesson_date'],
+        'mark': grade['mark'],
+        'value': _mark_value(grade['mark']),
+        'lesson_type': grade['lesson_type'],
+        'comment': grade['comment'],
+        'removed': False,
+    } for grade in grades
+        # Уведомление без оценки или предмета в историю не попадает
+        if grade.get('mark') is not None and grade.get('subject') is not None]
+    for start in range(0, len(rows), 100):
+        (Grade
+         .insert_many(rows[start:start + 100])
+         .on_conflict(conflict_target=[Grade.user, Grade.notification_id],
+                      preserve=[Grade.mark, Grade.value, Grade.lesson_type, Grade.comment, Grade.removed])
+         .execute())
+    if deleted:
+        (Grade
+         .update(removed=True)
+         .where((Grade.user == user_id) & Grade.notification_id.in_([int(grade['lesson_id']) for grade in deleted]))
+         .execute())
+
+
+def grade_averages(user_id: int, start: str, end: str) -> list[tuple[str, float, int]]:
+    query = (Grade
+             .select(Grade.subject, fn.AVG(Grade.value), fn.COUNT(Grade.value))
+             .where((Grade.user == user_id) & (Grade.lesson_date.between(start, end))
+                    & (Grade.removed == False) & (Grade.value.is_null(False)))
+             .group_by(Grade.subject)
+             .order_by(Grade.subject)
+             .tuples())
+    return [(subject, round(average, 2), count) for subject, average, count in query]
+
+
+class FSMState(Model):
+    key = CharField(primary_key=True)
+    state = CharField(null=True)
+    data = JSONField(default=dict)
+    expires_at = FloatField(index=True)
+
+    class Meta:
+        database = db
+
+
+def save_fsm_state(key: str, state: str | None, data: dict, expires_at: float):
+    (FSMState
+     .insert(key=key, state=state, data=data, expires_at=expires_at)
+     .on_conflict_replace()
+     .execute())
+
+
+def delete_fsm_states(keys: list[str]):
+    with db.atomic():
+        for start in range(0, len(keys), 500):
+            FSMState.delete().where(FSMState.key.in_(keys[start:start + 500])).execute()
+
+
+def load_fsm_states() -> list[FSMState]:
+    now = time.time()
+    FSMState.delete().where(FSMState.expires_at <= now).execute()
+    return list(FSMState.select().where(FSMState.expires_at > now).order_by(FSMState.expires_at))
+
+
+def migrate_columns(*models):
+    migrator = SqliteMigrator(db)
+    operations = []
+    for model in models:
+        table = model._meta.table_name
+        existing = {column.name for column in db.get_columns(table)}
+        operations += [
+            migrator.add_column(table, field.column_name, field)
+            for field in model._meta.sorted_fields
+            if field.column_name not in existing
+        ]
+    if operations:
+        migrate(*operations)
+
+
 def create_tables():
     with db:
         db.create_tables([
-            User
+            User,
+            Lease,
+            FSMState,
+            Timetable,
+            Grade
         ])
+        migrate_columns(User)
 
 
 if __name__ == "__main__":
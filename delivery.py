@@ -0,0 +1,166 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+
+from logger import logging
+from metrics import delivery_messages_total
+from ratelimit import TokenBucket
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+@dataclass
+class OutgoingMessage:
+    chat_id: int
+    text: str
+    parse_mode: str | None = None
+    kwargs: dict[str, Any] = field(default_factory=dict)
+    attempts: int = 0
+
+
+class DeliveryQueue:
+    def __init__(self, bot: Bot, rate: float = 30, chat_interval: float = 1.0, coalesce_delay: float = 1.0,
+                 consumers: int = 4, max_attempts: int = 5):
+        self.bot = bot
+        self.limiter = TokenBucket(rate)
+        self.chat_interval = chat_interval
+        self.coalesce_delay = coalesce_delay
+        self.consumers = consumers
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.failed = 0
+        self._queue: asyncio.Queue[OutgoingMessage] = asyncio.Queue()
+        self._pending: dict[tuple[int, str | None], list[str]] = {}
+        self._chat_ready_at: dict[int, float] = {}
+        # Сообщения чата, который сейчас занят или ещё не готов (chat_interval, retry_after).
+        # Они ждут здесь по порядку, не занимая отправителей, и по одному возвращаются в очередь
+        self._backlog: dict[int, deque[OutgoingMessage]] = {}
+        self._sending: set[int] = set()
+        self._released: dict[int, OutgoingMessage] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def qsize(self) -> int:
+        return self._queue.qsize() + len(self._pending) + sum(len(backlog) for backlog in self._backlog.values())
+
+    def send(self, chat_id: int, text: str, parse_mode: str | None = None, coalesce: bool = False, **kwargs):
+        # Сообщения с coalesce=True для одного чата в течение coalesce_delay
+        # склеиваются в одно (например, несколько новых оценок подряд)
+        if coalesce and not kwargs:
+            key = (chat_id, parse_mode)
+            if key not in self._pending:
+                self._pending[key] = []
+                asyncio.get_running_loop().call_later(self.coalesce_delay, self._flush, key)
+            self._pending[key].append(text)
+            return
+        self._queue.put_nowait(OutgoingMessage(chat_id, text, parse_mode, kwargs))
+
+    def _flush(self, key: tuple[int, str | None]):
+        texts = self._pending.pop(key, [])
+        chat_id, parse_mode = key
+        chunk = ''
+        for text in texts:
+            if chunk and len(chunk) + len(text) + 2 > MAX_MESSAGE_LENGTH:
+                self._queue.put_nowait(OutgoingMessage(chat_id, chunk, parse_mode))
+                chunk = ''
+            chunk = f'{chunk}\n\n{text}' if chunk else text
+        if chunk:
+            self._queue.put_nowait(OutgoingMessage(chat_id, chunk, parse_mode))
+
+    def _busy(self, chat_id: int) -> bool:
+        return (chat_id in self._sending or chat_id in self._released or chat_id in self._backlog
+                or self._chat_ready_at.get(chat_id, 0) > time.monotonic())
+
+    def _hold(self, message: OutgoingMessage):
+        chat_id = message.chat_id
+        backlog = self._backlog.setdefault(chat_id, deque())
+        backlog.append(message)
+        # Таймер есть, только пока чат свободен; иначе его заведёт завершившаяся отправка
+        if len(backlog) == 1 and chat_id not in self._sending and chat_id not in self._released:
+            self._schedule_release(chat_id)
+
+    def _schedule_release(self, chat_id: int):
+        delay = max(self._chat_ready_at.get(chat_id, 0) - time.monotonic(), 0)
+        asyncio.get_running_loop().call_later(delay, self._release, chat_id)
+
+    def _release(self, chat_id: int):
+        backlog = self._backlog.get(chat_id)
+        if not backlog:
+            return
+        message = backlog.popleft()
+        if not backlog:
+            del self._backlog[chat_id]
+        self._released[chat_id] = message
+        # Задача сообщения не завершалась, пока оно ждало, поэтому повторный put не должен
+        # увеличить счётчик незавершённых задач для join()
+        self._queue.put_nowait(message)
+        self._queue.task_done()
+
+    async def _deliver(self, message: OutgoingMessage) -> bool:
+        await self.limiter.acquire()
+        message.attempts += 1
+        try:
+            await self.bot.send_message(message.chat_id, message.text,
+                                        parse_mode=message.parse_mode, **message.kwargs)
+        except TelegramRetryAfter as e:
+            if message.attempts >= self.max_attempts:
+                raise
+            delivery_messages_total.inc(result='retry')
+            logging.warning(f'{message.chat_id} | Лимит Telegram, повтор через {e.retry_after}с')
+            self._chat_ready_at[message.chat_id] = time.monotonic() + e.retry_after
+            return False
+        self.sent += 1
+        delivery_messages_total.inc(result='sent')
+        self._chat_ready_at[message.chat_id] = time.monotonic() + self.chat_interval
+        return True
+
+    async def _consume(self):
+        while True:
+            message = await self._queue.get()
+            chat_id = message.chat_id
+            if self._released.get(chat_id) is message:
+                del self._released[chat_id]
+            elif self._busy(chat_id):
+                # Отправитель не ждёт занятый чат, а берёт следующее сообщение
+                self._hold(message)
+                continue
+
+            self._sending.add(chat_id)
+            done = True
+            try:
+                done = await self._deliver(message)
+            except Exception as e:
+                self.failed += 1
+                delivery_messages_total.inc(result='failed')
+                logging.error(f"Ошибка отправки сообщения пользователю {message.chat_id}: {e}")
+            finally:
+                self._sending.discard(chat_id)
+                if done:
+                    self._queue.task_done()
+                else:
+                    # Повтор после retry_after идёт раньше остальных сообщений чата
+                    self._backlog.setdefault(chat_id, deque()).appendleft(message)
+                if chat_id in self._backlog:
+                    self._schedule_release(chat_id)
+
+    async def join(self):
+        await self._queue.join()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.consumers)]
+
+    async def stop(self, timeout: float = 10):
+        for key in list(self._pending):
+            self._flush(key)
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f'Не доставлено сообщений: {self.qsize()}')
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
@@ -0,0 +1,119 @@
+import bisect
+import copy
+from dataclasses import dataclass, field
+
+
+@dataclass(frozen=True)
+class GradeUpdate:
+    new: dict
+    old: dict
+
+
+@dataclass
+class GradeChanges:
+    new_grades: list[dict] = field(default_factory=list)
+    updated_grades: list[GradeUpdate] = field(default_factory=list)
+    deleted_grades: list[dict] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.new_grades or self.updated_grades or self.deleted_grades)
+
+    def as_dict(self) -> dict:
+        return {
+            "new_grades": self.new_grades,
+            "updated_grades": [{"new": u.new, "old": u.old} for u in self.updated_grades],
+            "deleted_grades": self.deleted_grades,
+        }
+
+
+def diff_grades(previous: list[dict], current: list[dict]) -> GradeChanges:
+    changes = GradeChanges()
+    previous_index = {grade['lesson_id']: grade for grade in previous}
+    current_ids = set()
+
+    for grade in current:
+        lesson_id = grade['lesson_id']
+        current_ids.add(lesson_id)
+        previous_grade = previous_index.get(lesson_id)
+        if previous_grade is None:
+            changes.new_grades.append(grade)
+        elif grade != previous_grade:
+            changes.updated_grades.append(GradeUpdate(new=grade, old=previous_grade))
+
+    for lesson_id, grade in previous_index.items():
+        if lesson_id not in current_ids:
+            changes.deleted_grades.append(grade)
+
+    return changes
+
+
+# Месячная таблица оценок для картинки успеваемости хранится сразу в том виде,
+# в котором её рисует render_table: {'month': 'YYYY-MM', 'subjects': [...],
+# 'dates': [...], 'rows': [[оценки по датам] для каждого предмета]}
+def empty_matrix(month: str) -> dict:
+    return {'month': month, 'subjects': [], 'dates': [], 'rows': []}
+
+
+def _cell(matrix: dict, subject: str, date: str) -> tuple[int, int]:
+    subjects, dates, rows = matrix['subjects'], matrix['dates'], matrix['rows']
+    column = bisect.bisect_left(dates, date)
+    if column == len(dates) or dates[column] != date:
+        dates.insert(column, date)
+        for row in rows:
+            row.insert(column, '')
+    if subject not in subjects:
+        subjects.append(subject)
+        rows.append([''] * len(dates))
+    return subjects.index(subject), column
+
+
+def _add_mark(matrix: dict, grade: dict):
+    if grade.get('mark') is None or grade.get('subject') is None:
+        return
+    row, column = _cell(matrix, grade['subject'], grade['lesson_date'])
+    cell = matrix['rows'][row][column]
+    matrix['rows'][row][column] = f"{cell} {grade['mark']}" if cell else str(grade['mark'])
+
+
+def _remove_mark(matrix: dict, grade: dict):
+    if grade['subject'] not in matrix['subjects']:
+        return
+    column = bisect.bisect_left(matrix['dates'], grade['lesson_date'])
+    if column == len(matrix['dates']) or matrix['dates'][column] != grade['lesson_date']:
+        return
+    row = matrix['rows'][matrix['subjects'].index(grade['subject'])]
+    marks = row[column].split()
+    if str(grade['mark']) in marks:
+        marks.remove(str(grade['mark']))
+    row[column] = ' '.join(marks)
+
+
+def build_matrix(grades: list[dict], month: str) -> dict:
+    matrix = empty_matrix(month)
+    for grade in sorted(grades, key=lambda grade: int(grade['lesson_id'])):
+        if grade['lesson_date'].startswith(month):
+            _add_mark(matrix, grade)
+    return matrix
+
+
+def update_matrix(matrix: dict | None, grades: list[dict], changes: GradeChanges, month: str) -> dict | None:
+    # Возвращает новую таблицу или None, если менять нечего. В новом месяце
+    # (или при первом запуске) таблица собирается заново из окна уведомлений
+    if not matrix or matrix.get('month') != month:
+        return build_matrix(grades, month)
+    if not changes:
+        return None
+
+    matrix = copy.deepcopy(matrix)
+    for grade in changes.deleted_grades:
+        if grade['lesson_date'].startswith(month):
+            _remove_mark(matrix, grade)
+    for update in changes.updated_grades:
+        if update.old['lesson_date'].startswith(month):
+            _remove_mark(matrix, update.old)
+        if update.new['lesson_date'].startswith(month):
+            _add_mark(matrix, update.new)
+    for grade in changes.new_grades:
+        if grade['lesson_date'].startswith(month):
+            _add_mark(matrix, grade)
+    return matrix
@@ -1,15 +1,45 @@
+import os
+import random
 import sys
 from loguru import logger as logging
+
+ROLE = os.getenv('ROLE', 'all')
+# Каждый процесс пишет и ротирует свой файл: общий файл при ROLE=bot и нескольких
+# воркерах ротировали бы сразу несколько процессов. Без INSTANCE_ID воркеры различаются по pid.
+# Форкнутые процессы рендера в файл не пишут: при enqueue=True их записи уходят в поток родителя
+LOG_INSTANCE = os.getenv('INSTANCE_ID') or (f'{ROLE}-{os.getpid()}' if ROLE == 'worker' else ROLE)
+LOG_FILE = os.getenv('LOG_FILE', 'logs.log' if LOG_INSTANCE == 'all' else 'logs-{instance}.log').format(
+    instance=LOG_INSTANCE)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG')
+# Доля строк с пометкой sampled (поток по каждому пользователю на каждом цикле опроса),
+# которая всё же попадает в логи. Предупреждения и ошибки не сэмплируются
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.01))
+
+
+def _sample(record):
+    # Решение принимается один раз на запись, чтобы файл и консоль видели одни и те же строки
+    if record['extra'].get('sampled') and record['level'].no < logging.level('WARNING').no:
+        record['extra']['keep'] = random.random() < LOG_SAMPLE_RATE
+
+
+def _keep(record) -> bool:
+    return record['extra'].get('keep', True)
+
+
+logging.configure(patcher=_sample)
 logging.remove()
-logging.add("logs.log", format="<white>{time:YYYY-MM-DD HH:mm:ss}</white>"
-                               " | <level>{level: <8}</level>"
-                               " | <cyan><b>{line}</b></cyan>"
-                               " - <white><b>{message}</b></white>")
+# enqueue=True: запись в файл и консоль идёт из отдельного потока, event loop
+# только кладёт запись в очередь. Файл пишется в JSON, по строке на запись
+logging.add(LOG_FILE, level=LOG_LEVEL, filter=_keep, enqueue=True, serialize=True,
+            rotation=os.getenv('LOG_ROTATION', '50 MB'), retention=os.getenv('LOG_RETENTION', '14 days'),
+            compression='gz', backtrace=True, diagnose=False)
 
 # Add handler to log to stdout (console)
-logging.add(sys.stdout, format="<white>{time:YYYY-MM-DD HH:mm:ss}</white>"
-                               " | <level>{level: <8}</level>"
-                               " | <cyan><b>{line}</b></cyan>"
-                               " - <white><b>{message}</b></white>")
+logging.add(sys.stdout, level=LOG_LEVEL, filter=_keep, enqueue=True, diagnose=False,
+            format="<white>{time:YYYY-MM-DD HH:mm:ss}</white>"
+                   " | <level>{level: <8}</level>"
+                   " | <cyan><b>{line}</b></cyan>"
+                   " - <white><b>{message}</b></white>")
 
-logger = logging.opt(colors=True)
\ No newline at end of file
+logger = logging.opt(colors=True)
+sampled_logging = logging.bind(sampled=True)
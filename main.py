@@ -1,32 +1,82 @@
 import asyncio
 import os
+import time
 from aiogram import Bot, Dispatcher, F
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BufferedInputFile, InputFile, URLInputFile, FSInputFile
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BufferedInputFile
 from aiogram.filters.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import default_state
+from aiogram.exceptions import TelegramBadRequest
 from babel.dates import format_date
-import numpy as np
-import pandas as pd
-from matplotlib.table import Table
 import re
 import html
 import aiohttp
-import tempfile
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance
-import io
-from logger import logging
+from logger import logging, sampled_logging
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from database import User
+from api import nz_client
+from cache import response_cache
+from broadcast import Broadcast
+from database import User, create_tables, db_call, grade_averages, user_writes
+from delivery import DeliveryQueue
+from metrics import delivery_queue_depth, fsm_states, start_metrics_server
+from poller import GradePoller, PollSchedule
+from ratelimit import TokenBucket
+from storage import TTLStorage
+from shards import LeaseCoordinator, ShardCoordinator
+from tokens import token_manager
+from tracing import HandlerNameMiddleware, TelegramSpanMiddleware, TimingMiddleware
+import render
 
 load_dotenv()
 
 bot = Bot(os.getenv('TOKEN'))
-dp = Dispatcher()
+fsm_storage = TTLStorage(
+    ttl=float(os.getenv('FSM_TTL', 3600)),
+    max_size=int(os.getenv('FSM_MAX_SIZE', 10000)),
+    persist=os.getenv('FSM_PERSIST', '0') == '1',
+    private_states=('AuthStates:',),
+)
+dp = Dispatcher(storage=fsm_storage)
 scheduler = AsyncIOScheduler()
 
+bot.session.middleware(TelegramSpanMiddleware())
+dp.update.outer_middleware(TimingMiddleware(
+    slow_threshold=float(os.getenv('SLOW_UPDATE_MS', 1000)) / 1000,
+    profile_rate=float(os.getenv('PROFILE_SAMPLE_RATE', 0)),
+    profile_dir=os.getenv('PROFILE_DIR', 'profiles'),
+))
+dp.message.middleware(HandlerNameMiddleware())
+dp.callback_query.middleware(HandlerNameMiddleware())
+# ROLE: all — один процесс делает всё (по умолчанию); bot — только диспетчер и рассылки;
+# worker — только опрос оценок своих шардов. Шарды включаются через SHARDS
+ROLE = os.getenv('ROLE', 'all')
+shard_coordinator = ShardCoordinator(int(os.getenv('SHARDS'))) if os.getenv('SHARDS') and ROLE != 'bot' else None
+role_leases = LeaseCoordinator()
+# BOT_MODE: polling (по умолчанию) или webhook. Без WEBHOOK_URL вебхук не
+# регистрируется в Telegram — так удобно слать записанные апдейты локально
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+webhook_stopped = asyncio.Event()
+TELEGRAM_RATE = float(os.getenv('TELEGRAM_RATE', 25))
+# TELEGRAM_RATE — общий бюджет токена бота на все процессы: диспетчеру (ROLE=bot) достаётся
+# доля TELEGRAM_BOT_SHARE, воркеры делят остальное по числу своих шардов. При ROLE=all
+# без шардов процесс один и получает весь бюджет
+TELEGRAM_BOT_SHARE = float(os.getenv('TELEGRAM_BOT_SHARE', 0.4))
+
+
+def telegram_rate(owned_fraction: float) -> float:
+    bot_share = TELEGRAM_BOT_SHARE if ROLE != 'worker' else 0
+    poll_share = (1 - TELEGRAM_BOT_SHARE) * owned_fraction if ROLE != 'bot' else 0
+    return max(TELEGRAM_RATE * (bot_share + poll_share), 0.1)
+
+
+delivery = DeliveryQueue(bot, rate=telegram_rate(0 if shard_coordinator is not None else 1),
+                         consumers=int(os.getenv('TELEGRAM_SENDERS', 4)))
+
 class AuthStates(StatesGroup):
     login = State()
     password = State()
@@ -51,7 +101,7 @@ def markdown_protect(text):
 @dp.message(default_state, F.text == '/start')
 async def start(message: Message, state: FSMContext):
     await state.clear()
-    user = User.get_or_none(id=message.from_user.id)
+    user = await User.aget(message.from_user.id)
     if user and user.login and user.password:
         logging.info(f"{message.from_user.id} | /start")
         markup = ReplyKeyboardMarkup(keyboard=[
@@ -95,30 +145,33 @@ async def get_password(message: Message, state: FSMContext):
     logging.debug(f"{message.from_user.id} | Приняли пароль")
 
     try:
-        async with aiohttp.ClientSession() as session:
-            user: User = User.create(id=message.from_user.id)
-            await user.credentials(login, password, session)
-            print(await user.get_new_grades(session))
-            markup = ReplyKeyboardMarkup(keyboard=[
-                [KeyboardButton(text='📖 Дневник'), KeyboardButton(text='📅 Расписание')],
-                [KeyboardButton(text='📊 Успеваемость'), KeyboardButton(text='❌ Пропущенные уроки')],
-                [KeyboardButton(text='👤 Профиль')]
-            ], resize_keyboard=True)
-
-            await message.reply(f'✅ Авторизация успешна, {user.FIO}!', reply_markup=markup)
-            await message.delete()
-            logging.success(f"{message.from_user.id} | {user.FIO} | Авторизация успешна")
-            await state.clear()
+        user: User = await User.acreate(id=message.from_user.id)
+        await user.credentials(login, password)
+        try:
+            # Первый опрос запоминает текущие оценки, чтобы поллер не прислал их как новые
+            logging.debug(await user.get_new_grades())
+        except Exception as e:
+            logging.warning(f"{message.from_user.id} | Первый опрос оценок не удался: {e}")
+        markup = ReplyKeyboardMarkup(keyboard=[
+            [KeyboardButton(text='📖 Дневник'), KeyboardButton(text='📅 Расписание')],
+            [KeyboardButton(text='📊 Успеваемость'), KeyboardButton(text='❌ Пропущенные уроки')],
+            [KeyboardButton(text='👤 Профиль')]
+        ], resize_keyboard=True)
+
+        await message.reply(f'✅ Авторизация успешна, {user.FIO}!', reply_markup=markup)
+        await message.delete()
+        logging.success(f"{message.from_user.id} | {user.FIO} | Авторизация успешна")
+        await state.clear()
 
     except Exception as e:
         await message.reply(f'❌ Ошибка авторизации: {e}. Попробуйте еще раз. /start')
         logging.error(f"{message.from_user.id} | {e} Ошибка авторизации")
-        user.delete_instance()
+        await user.adelete()
         await state.clear()
 
 @dp.message(F.text == '📖 Дневник')
 async def diary(message: Message, state: FSMContext):
-    user: User = User.get_or_none(id=message.from_user.id)
+    user: User = await User.aget(message.from_user.id)
     if user:
         today = datetime.now()
         keyboard = []
@@ -142,12 +195,11 @@ async def diary(message: Message, state: FSMContext):
 @dp.callback_query(DiaryDateStates.waiting_for_date, F.data.startswith('diary_date:'))
 async def process_diary_date(callback_query: CallbackQuery, state: FSMContext):
     await callback_query.answer()
-    user = User.get_or_none(id=callback_query.from_user.id)
+    user = await User.aget(callback_query.from_user.id)
     if user:
         date_str = callback_query.data.split(":")[1]
-        async with aiohttp.ClientSession() as session:
-            await user._check_token_expire(session)
-            diary = await user._fetch_data('http://api-mobile.nz.ua/v1/schedule/diary', [date_str], session)
+        await user._check_token_expire()
+        diary = await user.fetch('schedule/diary', [date_str])
         data = await state.get_data()
         original_message_id = data.get('original_message_id')
         if diary and diary.get('dates'):
@@ -200,41 +252,37 @@ async def process_diary_date(callback_query: CallbackQuery, state: FSMContext):
 
         await state.clear()
 
+def build_timetable_message(days: list) -> str:
+    timetable_html = "📅 <b>Расписание на неделю:</b> ✨\n\n"
+
+    for day in days:
+        date_str_display = day['date']
+        day_name = format_date(datetime.strptime(date_str_display, '%Y-%m-%d'), 'EEEE', locale='ru_RU').title()
+        timetable_html += f"<b>{day_name} ({date_str_display}):</b> 🗓️\n"
+
+        if day['lessons']:
+            for call_number, subject_name, teacher_name in day['lessons']:
+                timetable_html += f"<i>{call_number}.</i> "
+                timetable_html += f"{html.escape(subject_name)} ({html.escape(teacher_name or '—')}) \n"
+        else:
+            timetable_html += "Нет уроков 🎉\n"
+
+    return timetable_html
+
+
+timetable_markup = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔄 Обновить расписание", callback_data="refresh_timetable")]
+])
+
+
 @dp.message(F.text == '📅 Расписание')
 async def timetable(message: Message):
-    user: User = User.get_or_none(id=message.from_user.id)
+    user: User = await User.aget(message.from_user.id)
     if user:
-        today = datetime.now()
-        start_of_week = today - timedelta(days=today.weekday())
-        end_of_week = start_of_week + timedelta(days=6)
-        dates = [start_of_week.strftime("%Y-%m-%d"), end_of_week.strftime("%Y-%m-%d")]
-        async with aiohttp.ClientSession() as session:
-            await user._check_token_expire(session)
-            diary_data = await user._fetch_data('http://api-mobile.nz.ua/v1/schedule/timetable', dates, session)
-
-        if diary_data and diary_data.get('dates'):
-            timetable_html = "📅 <b>Расписание на неделю:</b> ✨\n\n"
-
-            for day_data in diary_data['dates']:
-                date_str_display = day_data['date']
-                day_name = format_date(datetime.strptime(date_str_display, '%Y-%m-%d'), 'EEEE', locale='ru_RU').title()
-                timetable_html += f"<b>{day_name} ({date_str_display}):</b> 🗓️\n"
-
-                if day_data.get('calls'):
-                    for call in day_data['calls']:
-                        call_number = call['call_number']
-                        subjects = call['subjects']
-                        timetable_html += f"<i>{call_number}.</i> "
-
-                        for subject in subjects:
-                            subject_name = html.escape(subject['subject_name'])
-                            teacher_name = html.escape(subject['teacher']['name']) if subject.get('teacher') else "—"
-                            timetable_html += f"{subject_name} ({teacher_name}) \n"
+        days = await user.timetable()
 
-                else:
-                    timetable_html += "Нет уроков 🎉\n"
-
-            await message.reply(timetable_html, parse_mode="HTML")
+        if days:
+            await message.reply(build_timetable_message(days), parse_mode="HTML", reply_markup=timetable_markup)
             logging.success(f'{message.from_user.id} | {user.FIO} | Вывод рассписания')
         else:
             await message.reply("Расписание на эту неделю не найдено. 😔")
@@ -243,51 +291,134 @@ async def timetable(message: Message):
         await message.reply("Сначала необходимо авторизоваться. /start")
 
 
+@dp.callback_query(F.data == 'refresh_timetable')
+async def refresh_timetable(callback_query: CallbackQuery):
+    user = await User.aget(callback_query.from_user.id)
+    if not user:
+        await callback_query.answer("Сначала необходимо авторизоваться. /start", show_alert=True)
+        return
+    try:
+        days = await user.timetable(refresh=True)
+    except Exception as e:
+        logging.warning(f'{user.id} | Не удалось обновить расписание: {e}')
+        await callback_query.answer("Не удалось обновить расписание, попробуйте позже", show_alert=True)
+        return
+    await callback_query.answer("Расписание обновлено")
+    if days:
+        try:
+            await callback_query.message.edit_text(build_timetable_message(days), parse_mode="HTML",
+                                                   reply_markup=timetable_markup)
+        except TelegramBadRequest:
+            # Расписание не изменилось — Telegram не даёт отредактировать сообщение тем же текстом
+            pass
+    logging.info(f'{user.id} | {user.FIO} | Расписание обновлено по запросу')
+
+
+def build_performance_message(performance_data: dict | None,
+                              averages: list[tuple[str, float, int]] | None = None) -> str | None:
+    # averages — средние по локальной истории оценок; список предметов и пропуски
+    # всё равно берутся из отчёта NZ, если он есть
+    subjects = (performance_data or {}).get('subjects') or []
+    if averages is None and not subjects:
+        return None
+    performance_html = "📊 <b>Успеваемость за текущий месяц:</b>\n\n"
+
+    if averages is not None:
+        local = {subject_name: (avg_grade, count) for subject_name, avg_grade, count in averages}
+        names = [subject['subject_name'] for subject in subjects]
+        names += [subject_name for subject_name in local if subject_name not in names]
+        for name in names:
+            subject_name = html.escape(name)
+            if name in local:
+                avg_grade, count = local[name]
+                performance_html += f"<b>{subject_name}:</b> {avg_grade} ({count})\n"
+            else:
+                performance_html += f"<b>{subject_name}:</b> Нет оценок\n"
+        if not names:
+            performance_html += "В этом месяце оценок пока нет\n"
+    else:
+        for subject in subjects:
+            subject_name = html.escape(subject['subject_name'])
+            marks = subject.get('marks', [])
+            if marks:
+                try:
+                    avg_grade = round(sum(int(mark) for mark in marks) / len(marks), 2)
+                    performance_html += f"<b>{subject_name}:</b> {avg_grade}\n"
+                except (ValueError, TypeError):
+                    performance_html += f"<b>{subject_name}:</b> Невозможно вычислить средний балл (некорректные оценки)\n"
+            else:
+                performance_html += f"<b>{subject_name}:</b> Нет оценок\n"
+
+    if (performance_data or {}).get('missed'):
+        missed_days = performance_data['missed'].get('days', 0)
+        missed_lessons = performance_data['missed'].get('lessons', 0)
+        performance_html += f"\n<b>Пропущено дней:</b> {missed_days}\n"
+        performance_html += f"<b>Пропущено уроков:</b> {missed_lessons}\n"
+    return performance_html
+
+
+performance_markup = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📋 Подробнее", callback_data="performance_details")]
+])
+SUBJECT_FETCH_CONCURRENCY = int(os.getenv('SUBJECT_FETCH_CONCURRENCY', 5))
+
+
+def build_subject_grades_message(subject_name: str, lessons: list | Exception) -> str:
+    text = f"<b>{html.escape(subject_name)}</b>\n"
+    if isinstance(lessons, Exception):
+        return text + "Не удалось загрузить оценки 😔"
+    marks = [lesson for lesson in lessons if lesson.get('mark')]
+    if not marks:
+        return text + "Нет оценок"
+    for lesson in marks:
+        date = datetime.strptime(lesson['lesson_date'], '%Y-%m-%d').strftime('%d.%m')
+        line = f"{date} — <b>{html.escape(str(lesson['mark']))}</b>"
+        if lesson.get('type'):
+            line += f" ({html.escape(lesson['type'])})"
+        if lesson.get('comment'):
+            line += f": <i>{html.escape(lesson['comment'])}</i>"
+        text += line + "\n"
+    return text
+
+
 @dp.message(F.text == '📊 Успеваемость')
 async def student_performance(message: Message):
-    user: User = User.get_or_none(id=message.from_user.id)
+    user: User = await User.aget(message.from_user.id)
     if user:
         today = datetime.now()
         start_date = today.replace(day=1).strftime("%Y-%m-%d")
         end_date = today.strftime("%Y-%m-%d")
         try:
-            async with aiohttp.ClientSession() as session:
-                    await user._check_token_expire(session)
-                    performance_data = await user._fetch_data(
-                        'http://api-mobile.nz.ua/v1/schedule/student-performance',
-                        [start_date, end_date], session
+            if user.grades_since is not None and user.grades_since <= start_date:
+                # Бот без пропусков видел все оценки этого месяца — средние считаются по локальной
+                # истории, а отчёт NZ (из кэша ответов) нужен только для предметов и пропусков
+                averages = await db_call(grade_averages, user.id, start_date, end_date)
+                try:
+                    await user._check_token_expire()
+                    performance_data = await user.fetch(
+                        'schedule/student-performance', [start_date, end_date]
                     )
-
-            if performance_data and performance_data.get('subjects'):
-                performance_html = "📊 <b>Успеваемость за текущий месяц:</b>\n\n"
-
-                for subject in performance_data['subjects']:
-                    subject_name = html.escape(subject['subject_name'])
-                    marks = subject.get('marks', [])
-                    if marks:
-                        try:
-                            avg_grade = round(sum(int(mark) for mark in marks) / len(marks), 2)
-                            performance_html += f"<b>{subject_name}:</b> {avg_grade}\n"
-                        except (ValueError, TypeError):
-                            performance_html += f"<b>{subject_name}:</b> Невозможно вычислить средний балл (некорректные оценки)\n"
-                    else:
-                        performance_html += f"<b>{subject_name}:</b> Нет оценок\n"
-
-                if performance_data.get('missed'):
-                    missed_days = performance_data['missed'].get('days', 0)
-                    missed_lessons = performance_data['missed'].get('lessons', 0)
-                    performance_html += f"\n<b>Пропущено дней:</b> {missed_days}\n"
-                    performance_html += f"<b>Пропущено уроков:</b> {missed_lessons}\n"
-                image = user.generate_image()
-
-                with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_file:
-                    temp_file.write(image)
-                    temp_file_name = temp_file.name
-                logging.debug(temp_file_name)
-                photo = FSInputFile(temp_file_name, filename='performance_img.png')
-                await message.answer_photo(photo, caption=performance_html, parse_mode="HTML")
-
-                os.remove(temp_file_name)
+                except Exception as e:
+                    logging.warning(f'{user.id} | Отчёт об успеваемости недоступен, только локальные оценки: {e}')
+                    performance_data = None
+                performance_html = build_performance_message(performance_data, averages)
+            else:
+                await user._check_token_expire()
+                performance_data = await user.fetch(
+                    'schedule/student-performance', [start_date, end_date]
+                )
+                performance_html = build_performance_message(performance_data)
+
+            if performance_html:
+                # Таблица прошлого месяца не показывается, пока опрос не начнёт новую
+                current = user.mig if user.mig.get('month') == today.strftime('%Y-%m') else None
+                image = await render.render_performance(user.FIO, current)
+                if image:
+                    photo = BufferedInputFile(image, filename='performance_img.png')
+                    await message.answer_photo(photo, caption=performance_html, parse_mode="HTML",
+                                               reply_markup=performance_markup)
+                else:
+                    await message.answer(performance_html, parse_mode="HTML", reply_markup=performance_markup)
 
                 logging.success(f'{message.from_user.id} | {user.FIO} | Вывод успеваемости')
 
@@ -300,6 +431,36 @@ async def student_performance(message: Message):
 
     else:
         await message.reply("Сначала необходимо авторизоваться. /start")
+
+
+@dp.callback_query(F.data == 'performance_details')
+async def performance_details(callback_query: CallbackQuery):
+    user = await User.aget(callback_query.from_user.id)
+    if not user:
+        await callback_query.answer("Сначала необходимо авторизоваться. /start", show_alert=True)
+        return
+    await callback_query.answer("Загружаю оценки по предметам…")
+    today = datetime.now()
+    dates = [today.replace(day=1).strftime("%Y-%m-%d"), today.strftime("%Y-%m-%d")]
+    try:
+        await user._check_token_expire()
+        performance_data = await user.fetch('schedule/student-performance', dates)
+        subjects = {subject['subject_id']: subject['subject_name']
+                    for subject in (performance_data or {}).get('subjects', []) if 'subject_id' in subject}
+        if not subjects:
+            delivery.send(user.id, "Список предметов пока недоступен.")
+            return
+        started = time.perf_counter()
+        grades = await user.fetch_subject_grades(dates, subjects, concurrency=SUBJECT_FETCH_CONCURRENCY)
+        # Блоки по предметам склеиваются очередью доставки в сообщения до 4096 символов
+        for subject_name, lessons in grades.items():
+            delivery.send(user.id, build_subject_grades_message(subject_name, lessons), parse_mode="HTML", coalesce=True)
+        logging.info(f'{user.id} | {user.FIO} | Оценки по {len(subjects)} предметам за {time.perf_counter() - started:.2f}с')
+    except Exception as e:
+        logging.exception(f"An unexpected error occurred: {e}")
+        delivery.send(user.id, f"Произошла непредвиденная ошибка: {e}")
+
+
 marks2emoji = {
     1: "💩",
     2: "💅",
@@ -317,75 +478,94 @@ marks2emoji = {
 
 # ...
 
+async def poll_user(user: User):
+    if shard_coordinator is not None and not shard_coordinator.owns(user.id):
+        return None
+    time_user = datetime.now()
+    marks = None
+    try:
+        marks = await user.get_new_grades()
+        (logging if marks else sampled_logging).success(marks)
+        if not marks:
+            return marks
+
+        for grade in marks.new_grades:
+            emoji = marks2emoji[int(grade['mark'])]
+            message = (
+                f"{emoji} *Новая оценка!* {emoji}\n\n"
+                f"*Оценка:* {grade['mark']}\n"
+                f"*Предмет:* {grade['subject']} ({grade['lesson_type']})\n"
+                f"*Дата:* {grade['lesson_date']}\n"
+            )
+
+            if grade['comment']:
+                message += f"*Комментарий:* {markdown_protect(grade['comment'])}\n"
+
+            delivery.send(user.id, message, parse_mode="Markdown", coalesce=True)
+            logging.info(f"{user.FIO} Новая оценка {grade['mark']} | {grade['subject']}")
+
+        if marks.updated_grades:
+            for grade_data in marks.updated_grades:
+                new_grade = grade_data.new
+                old_grade = grade_data.old
+
+                emoji = marks2emoji[int(new_grade['mark'])]
+                message = (
+                    f"{emoji} *Изменение оценки!* {emoji}\n\n"
+                    f"*Предмет:* {new_grade['subject']} ({new_grade['lesson_type']})\n"
+                    f"*Дата:* {new_grade['lesson_date']}\n"
+                    f"*Оценка:* {old_grade['mark']} -> {new_grade['mark']}\n"
+                )
+
+                if old_grade['comment']:
+                    message += f"*Старый комментарий:* {markdown_protect(old_grade['comment'])}\n"
+                if new_grade['comment']:
+                    message += f"*Новый комментарий:* {markdown_protect(new_grade['comment'])}\n"
+
+                delivery.send(user.id, message, parse_mode="Markdown", coalesce=True)
+                logging.info(f"{user.FIO} Изменение оценки {old_grade['mark']} -> {new_grade['mark']} | {new_grade['subject']}")
+    finally:
+        sampled_logging.debug(f"	{user.FIO} - ({datetime.now() - time_user}) {marks if marks else None}")
+    return marks
+
+
+poller = GradePoller(poll_user, workers=int(os.getenv('POLL_WORKERS', 20)), circuit=nz_client.breaker,
+                     flush_writes=user_writes.flush, refresh_user=User.refresh_credentials)
+poll_schedule = PollSchedule()
+POLL_RATE = float(os.getenv('POLL_RATE', 10))
+poll_rate_limiter = TokenBucket(rate=POLL_RATE)
+
+
+async def load_poll_users() -> list[User]:
+    if shard_coordinator is not None:
+        owned = shard_coordinator.owned
+        # POLL_RATE — общий бюджет всех воркеров: каждый берёт долю по числу своих шардов
+        poll_rate_limiter.set_rate(max(POLL_RATE * len(owned) / shard_coordinator.shard_count, 0.1))
+        delivery.limiter.set_rate(telegram_rate(len(owned) / shard_coordinator.shard_count))
+        return await User.active(shard_coordinator.shard_count, owned)
+    return await User.active()
+
+
 async def background_task():
-    async with aiohttp.ClientSession() as session:
-        while True:
-            time_all = datetime.now()
-            users = list(User.select().where(User.token_expired != None))
-            
-            for user in users:
-                try:
-                    time_user = datetime.now()
-                    
-                    marks = await user.get_new_grades(session)
-                    logging.success(marks)
-                    if not marks or not marks['new_grades']:
-                        continue
-                    
-                    for grade in marks['new_grades']:
-                        emoji = marks2emoji[int(grade['mark'])]
-                        message = (
-                            f"{emoji} *Новая оценка!* {emoji}\n\n"
-                            f"*Оценка:* {grade['mark']}\n"
-                            f"*Предмет:* {grade['subject']} ({grade['lesson_type']})\n"
-                            f"*Дата:* {grade['lesson_date']}\n"
-                        )
-                        
-                        if grade['comment']:
-                            message += f"*Комментарий:* {markdown_protect(grade['comment'])}\n"
-                        
-                        try:
-                            await bot.send_message(user.id, message, parse_mode="Markdown")
-                            logging.info(f"{user.FIO} Новая оценка {grade['mark']} | {grade['subject']}")
-                        except Exception as e:
-                            logging.error(f"Ошибка отправки сообщения пользователю {user.FIO}: {e}")
-                    
-                    if marks['updated_grades']:
-                        for grade_data in marks['updated_grades']:
-                            new_grade = grade_data['new']
-                            old_grade = grade_data['old']
-                            
-                            emoji = marks2emoji[int(new_grade['mark'])]
-                            message = (
-                                f"{emoji} *Изменение оценки!* {emoji}\n\n"
-                                f"*Предмет:* {new_grade['subject']} ({new_grade['lesson_type']})\n"
-                                f"*Дата:* {new_grade['lesson_date']}\n"
-                                f"*Оценка:* {old_grade['mark']} -> {new_grade['mark']}\n"
-                            )
-                            
-                            if old_grade['comment']:
-                                message += f"*Старый комментарий:* {markdown_protect(old_grade['comment'])}\n"
-                            if new_grade['comment']:
-                                message += f"*Новый комментарий:* {markdown_protect(new_grade['comment'])}\n"
-                            
-                            try:
-                                await bot.send_message(user.id, message, parse_mode="Markdown")
-                                logging.info(f"{user.FIO} Изменение оценки {old_grade['mark']} -> {new_grade['mark']} | {new_grade['subject']}")
-                            except Exception as e:
-                                logging.error(f"Ошибка отправки сообщения пользователю {user.FIO}: {e}")
-                
-                except Exception as e:
-                    logging.exception(f"Ошибка в цикле: {e}. Продолжаем работу")
-                finally:
-                    logging.debug(f"	{user.FIO} - ({datetime.now() - time_user}) {marks if marks else None}")
-            
-            logging.info(f'Время цикла: {datetime.now() - time_all}')
-            await asyncio.sleep(60)
+    await poller.run_scheduled(poll_schedule, load_poll_users, poll_rate_limiter)
+
+
+async def refresh_user_token(user_id: int):
+    user = await User.aget(user_id)
+    if user and user.token_expired:
+        await user._refresh_token()
+        logging.info(f'{user.id} | {user.FIO} | Плановое обновление токена')
+
+
+async def token_refresh_task():
+    for user in await User.active():
+        token_manager.schedule(user.id, user.token_expired)
+    await token_manager.run(refresh_user_token)
 
 
 @dp.message(F.text == '❌ Пропущенные уроки')
 async def missed_lessons(message: Message):
-    user: User = User.get_or_none(id=message.from_user.id)
+    user: User = await User.aget(message.from_user.id)
     if user:
         today = datetime.now()
         start_of_month = today.replace(day=1)
@@ -393,8 +573,7 @@ async def missed_lessons(message: Message):
         dates = [start_of_month.strftime("%Y-%m-%d"), end_of_month.strftime("%Y-%m-%d")]
 
         try:
-            async with aiohttp.ClientSession() as session:
-                missed_lessons_data = await user._fetch_data('http://api-mobile.nz.ua/v1/schedule/missed-lessons', dates, session)
+            missed_lessons_data = await user.fetch('schedule/missed-lessons', dates)
 
             if missed_lessons_data and missed_lessons_data.get('missed_lessons'):
                 missed_lessons_html = "❌ <b>Пропущенные уроки за месяц:</b>\n\n"
@@ -422,7 +601,7 @@ async def missed_lessons(message: Message):
 
 @dp.message(F.text == '👤 Профиль')
 async def profile(message: Message):
-    user: User = User.get_or_none(id=message.from_user.id)
+    user: User = await User.aget(message.from_user.id)
     if user:
         profile_info = (
             f"👤 *Ваш профиль:*\n\n"
@@ -445,9 +624,11 @@ async def profile(message: Message):
 
 @dp.callback_query(F.data == 'logout')
 async def logout(callback_query: CallbackQuery):
-    user: User = User.get_or_none(id=callback_query.from_user.id)
+    user: User = await User.aget(callback_query.from_user.id)
     if user:
-        user.delete_instance()
+        await user.adelete()
+        token_manager.forget(user.id)
+        response_cache.invalidate(lambda key: key[0] == user.student_id)
 
         await callback_query.message.answer("Вы успешно вышли из аккаунта. /start", reply_markup=ReplyKeyboardRemove())
         await callback_query.answer()
@@ -456,89 +637,219 @@ async def logout(callback_query: CallbackQuery):
         await callback_query.answer("Вы не авторизованы.")
 
 
-async def send_tomorrow_homework(user: User, session, callback_query: CallbackQuery = None):
-    message_id = callback_query.message.message_id if callback_query else None
+def homework_date() -> str:
+    return (datetime.today() + timedelta(days=1)).strftime("%Y-%m-%d")
 
-    tomorrow = (datetime.today() + timedelta(days=1)).strftime("%Y-%m-%d")
 
-    try:
-        diary = await user._fetch_data("http://api-mobile.nz.ua/v1/schedule/diary", [tomorrow], session)
+def build_homework_message(diary: dict | None, tomorrow: str) -> tuple[str, InlineKeyboardMarkup | None]:
+    if not diary or not diary.get('dates'):
+        return f"На завтра ({tomorrow}) домашнее задание не найдено.", None
 
-        if diary and diary.get('dates'):
-            date_data = diary['dates'][0]
-            calls = date_data['calls']
+    homework_message = f"📅 <b>Домашнее задание на {tomorrow}:</b>\n\n"
+    for call in diary['dates'][0]['calls']:
+        for subject in call['subjects']:
+            if subject['hometask']:
+                homework_message += f"<b>{call['call_number']}. {html.escape(subject['subject_name'])}:</b>\n"
+                for task in subject['hometask']:
+                    homework_message += f"• {html.escape(task)}\n"
 
-            homework_message = f"📅 <b>Домашнее задание на {tomorrow}:</b>\n\n"
+    markup = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Обновить данные", callback_data=f"refresh_homework:{tomorrow}")]
+    ])
+    return homework_message, markup
 
-            for call in calls:
-                for subject in call['subjects']:
-                    if subject['hometask']:
-                        homework_message += f"<b>{call['call_number']}. {html.escape(subject['subject_name'])}:</b>\n"
-                        for task in subject['hometask']:
-                            homework_message += f"• {html.escape(task)}\n"
 
-            markup = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔄 Обновить данные", callback_data=f"refresh_homework:{tomorrow}")]
-            ])
+async def fetch_homework(user: User, tomorrow: str, session: aiohttp.ClientSession = None) -> dict | None:
+    await user._check_token_expire(session)
+    return await user._fetch_data("schedule/diary", [tomorrow], session)
 
-            try:
-                if message_id:
-                    await bot.edit_message_text(
-                        homework_message, chat_id=user.id, message_id=message_id,
-                        parse_mode="HTML", reply_markup=markup
-                    )
-                    logging.info(f'{user.id} | {user.FIO} | Домашнее задание на завтра обновлено')
 
-                else:
-                    await bot.send_message(
-                        user.id, homework_message, parse_mode="HTML", reply_markup=markup, disable_web_page_preview=True
-                    )
-                    logging.info(f'{user.id} | {user.FIO} | Домашнее задание на завтра отправлено')
+async def send_tomorrow_homework(user: User, session: aiohttp.ClientSession = None, callback_query: CallbackQuery = None):
+    message_id = callback_query.message.message_id if callback_query else None
 
-            except Exception as e:
-                if "message is not modified" in str(e):
-                    if callback_query: 
-                       await bot.answer_callback_query(callback_query.id, "Данные актуальны")
-                    logging.info(f'{user.id} | {user.FIO} | Данные по домашнему заданию актуальны')
-                else:
-                    raise e
+    tomorrow = homework_date()
 
-        else:
-            not_found_message = f"На завтра ({tomorrow}) домашнее задание не найдено."
+    try:
+        diary = await fetch_homework(user, tomorrow, session)
+        homework_message, markup = build_homework_message(diary, tomorrow)
+
+        try:
             if message_id:
-                await bot.edit_message_text(not_found_message, chat_id=user.id, message_id=message_id)
+                await bot.edit_message_text(
+                    homework_message, chat_id=user.id, message_id=message_id,
+                    parse_mode="HTML", reply_markup=markup
+                )
+                logging.info(f'{user.id} | {user.FIO} | Домашнее задание на завтра обновлено')
+
             else:
-                await bot.send_message(user.id, not_found_message)
+                await bot.send_message(
+                    user.id, homework_message, parse_mode="HTML", reply_markup=markup, disable_web_page_preview=True
+                )
+                logging.info(f'{user.id} | {user.FIO} | Домашнее задание на завтра отправлено')
+
+        except Exception as e:
+            if "message is not modified" in str(e):
+                if callback_query: 
+                   await bot.answer_callback_query(callback_query.id, "Данные актуальны")
+                logging.info(f'{user.id} | {user.FIO} | Данные по домашнему заданию актуальны')
+            else:
+                raise e
 
     except Exception as e:
         logging.exception(f"Ошибка при отправке домашнего задания: {e}")
         await bot.send_message(user.id, "Произошла ошибка при получении домашнего задания.")
 
 
+homework_broadcast = Broadcast(concurrency=int(os.getenv('BROADCAST_CONCURRENCY', 10)))
 
-async def scheduled_homework_task():
-    for user in User.select().where(User.token_expired != None):
-        async with aiohttp.ClientSession() as session:
-            await send_tomorrow_homework(user, session)
+
+async def prefetch_homework_task():
+    tomorrow = homework_date()
+    await homework_broadcast.prefetch(tomorrow, await User.active(), lambda user: fetch_homework(user, tomorrow))
+
+
+async def refresh_timetables_task():
+    users = await User.active()
+    semaphore = asyncio.Semaphore(int(os.getenv('BROADCAST_CONCURRENCY', 10)))
+
+    async def refresh_one(user: User) -> bool:
+        async with semaphore:
+            try:
+                await user.refresh_timetable()
+                return True
+            except Exception as e:
+                logging.error(f'{user.id} | Ошибка ночного обновления расписания: {e}')
+                return False
+
+    started = time.perf_counter()
+    refreshed = sum(await asyncio.gather(*(refresh_one(user) for user in users)))
+    logging.info(f'Ночное обновление расписаний: {refreshed}/{len(users)} за {time.perf_counter() - started:.1f}с '
+                 f'| ошибок {len(users) - refreshed}')
 
 
+async def scheduled_homework_task():
+    tomorrow = homework_date()
+    # Если предзагрузка ещё идёт, take дождётся её
+    prefetched = await homework_broadcast.take(tomorrow)
+    if prefetched is None:
+        await prefetch_homework_task()
+        prefetched = await homework_broadcast.take(tomorrow)
+    results, stats = prefetched
+
+    started = time.perf_counter()
+    for user, diary in results:
+        if isinstance(diary, Exception):
+            delivery.send(user.id, "Произошла ошибка при получении домашнего задания.")
+        else:
+            homework_message, markup = build_homework_message(diary, tomorrow)
+            delivery.send(user.id, homework_message, parse_mode="HTML",
+                          reply_markup=markup, disable_web_page_preview=True)
+        stats.enqueued += 1
+    await delivery.join()
+    stats.delivery_duration = time.perf_counter() - started
+
+    logging.info(
+        f'Рассылка ДЗ на {tomorrow}: пользователей {stats.users} | загружено {stats.fetched} '
+        f'| ошибок {stats.failed} | загрузка {stats.fetch_duration:.1f}с | доставка {stats.delivery_duration:.1f}с'
+    )
 
 
 @dp.callback_query(F.data.startswith('refresh_homework:'))
 async def refresh_homework(callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
-    user = User.get_or_none(id=user_id)
+    user = await User.aget(user_id)
     if user:
         await send_tomorrow_homework(user, callback_query=callback_query)
     else:
         await bot.send_message(user_id, "Пользователь не найден. Попробуйте авторизоваться снова. /start")
+async def run_worker():
+    try:
+        await background_task()
+    finally:
+        await user_writes.flush()
+        await delivery.stop()
+        await nz_client.close()
+
+
+async def keep_dispatcher_lease():
+    await role_leases.keep('dispatcher')
+    if BOT_MODE == 'webhook':
+        webhook_stopped.set()
+    else:
+        await dp.stop_polling()
+
+
+async def run_webhook():
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, handle_in_background=True,
+        secret_token=os.getenv('WEBHOOK_SECRET'),
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, os.getenv('WEBHOOK_HOST', '127.0.0.1'), int(os.getenv('WEBHOOK_PORT', 8080))).start()
+    if os.getenv('WEBHOOK_URL'):
+        await bot.set_webhook(
+            os.getenv('WEBHOOK_URL').rstrip('/') + WEBHOOK_PATH,
+            secret_token=os.getenv('WEBHOOK_SECRET'),
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    logging.info(f'Вебхук слушает {WEBHOOK_PATH} на порту {os.getenv("WEBHOOK_PORT", 8080)}')
+    try:
+        await webhook_stopped.wait()
+    finally:
+        await runner.cleanup()
+
+
 async def main():
-    asyncio.create_task(background_task())
+    if BOT_MODE == 'webhook' and ROLE != 'worker' and os.getenv('WEBHOOK_URL') and not os.getenv('WEBHOOK_SECRET'):
+        # Без секрета любой, кто достучится до порта, пришлёт апдейт от имени чужого пользователя
+        raise RuntimeError('Публичный вебхук (WEBHOOK_URL) требует WEBHOOK_SECRET')
+    await db_call(create_tables)
+    delivery.start()
+    asyncio.create_task(user_writes.run())
+    delivery_queue_depth.set_function(delivery.qsize)
+    fsm_states.set_function(lambda: len(fsm_storage))
+    if os.getenv('METRICS_PORT'):
+        metrics_runner = await start_metrics_server(os.getenv('METRICS_HOST', '127.0.0.1'), int(os.getenv('METRICS_PORT')))
+        dp.shutdown.register(metrics_runner.cleanup)
+    if shard_coordinator is not None:
+        await shard_coordinator.rebalance()
+        asyncio.create_task(shard_coordinator.run())
+
+    if ROLE == 'worker':
+        logging.info(f'{role_leases.owner} | Воркер опроса оценок запущен')
+        await run_worker()
+        return
+
+    if ROLE == 'bot':
+        await role_leases.wait_for('dispatcher')
+        asyncio.create_task(keep_dispatcher_lease())
+    else:
+        asyncio.create_task(background_task())
+
+    await fsm_storage.load()
+    asyncio.create_task(fsm_storage.run())
+    dp.shutdown.register(nz_client.close)
+    dp.shutdown.register(render.shutdown)
+    dp.shutdown.register(delivery.stop)
+    dp.shutdown.register(user_writes.flush)
+    asyncio.create_task(token_refresh_task())
+    if os.getenv('RENDER_WARMUP', '1') == '1':
+        asyncio.create_task(render.warmup())
     
 
+    prefetch_at = datetime(2000, 1, 1, 11, 0) - timedelta(minutes=int(os.getenv('HOMEWORK_PREFETCH_MINUTES', 10)))
+    scheduler.add_job(prefetch_homework_task, 'cron', hour=prefetch_at.hour, minute=prefetch_at.minute)
     scheduler.add_job(scheduled_homework_task, 'cron', hour=11, minute=0)
+    scheduler.add_job(refresh_timetables_task, 'cron', hour=int(os.getenv('TIMETABLE_REFRESH_HOUR', 3)), minute=0)
     scheduler.start()
-    await dp.start_polling(bot)
+    if BOT_MODE == 'webhook':
+        await run_webhook()
+    else:
+        await dp.start_polling(bot)
 
     
 if __name__ == '__main__':
@@ -0,0 +1,184 @@
+import math
+from typing import Callable
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'Метрика {self.name} ожидает метки {self.labelnames}, получено {tuple(labels)}')
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines += self.samples()
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._function: Callable[[], float] | None = None
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    def samples(self) -> list[str]:
+        if self._function is not None:
+            return [f'{self.name} {_format_value(self._function())}']
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}'
+                for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        entry = self._values.setdefault(self._key(labels), [[0] * len(self.buckets), 0.0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'Метрика {metric.name} уже зарегистрирована')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+registry = Registry()
+
+poll_cycle_seconds = registry.register(Histogram(
+    'nz_poll_cycle_seconds', 'Длительность цикла опроса между синхронизациями списка пользователей', buckets=(1, 5, 10, 30, 60, 120, 300, 600)))
+poll_user_seconds = registry.register(Histogram(
+    'nz_poll_user_seconds', 'Время опроса одного пользователя'))
+poll_users_total = registry.register(Counter(
+    'nz_poll_users_total', 'Опрошено пользователей', ('result',)))
+poll_scheduled_users = registry.register(Gauge(
+    'nz_poll_scheduled_users', 'Пользователей в расписании опроса'))
+api_request_seconds = registry.register(Histogram(
+    'nz_api_request_seconds', 'Задержка запросов к NZ API', ('endpoint',)))
+api_responses_total = registry.register(Counter(
+    'nz_api_responses_total', 'Ответы NZ API по кодам', ('endpoint', 'status')))
+api_retries_total = registry.register(Counter(
+    'nz_api_retries_total', 'Повторные запросы к NZ API', ('endpoint',)))
+api_circuit_state = registry.register(Gauge(
+    'nz_api_circuit_state', 'Состояние предохранителя NZ API: 0 закрыт, 1 пробный запрос, 2 открыт'))
+delivery_queue_depth = registry.register(Gauge(
+    'telegram_delivery_queue_depth', 'Сообщений в очереди отправки'))
+delivery_messages_total = registry.register(Counter(
+    'telegram_delivery_messages_total', 'Отправка сообщений в Telegram', ('result',)))
+token_refresh_total = registry.register(Counter(
+    'nz_token_refresh_total', 'Обновления токенов NZ', ('result',)))
+render_seconds = registry.register(Histogram(
+    'render_image_seconds', 'Время генерации таблицы успеваемости', buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)))
+fsm_states = registry.register(Gauge(
+    'bot_fsm_states', 'Незавершённых диалогов в хранилище FSM'))
+
+handler_seconds = registry.register(Histogram(
+    'bot_handler_seconds', 'Время обработки апдейта', ('handler',)))
+handler_span_seconds = registry.register(Histogram(
+    'bot_handler_span_seconds', 'Время этапов обработки апдейта', ('handler', 'span')))
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
+
+
+async def start_metrics_server(host: str = '127.0.0.1', port: int = 9100) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,239 @@
+import asyncio
+import heapq
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable
+
+from logger import logging
+from metrics import poll_cycle_seconds, poll_scheduled_users, poll_user_seconds, poll_users_total
+from ratelimit import TokenBucket
+from resilience import CircuitBreaker, CircuitOpenError
+
+
+@dataclass
+class CycleStats:
+    users: int = 0
+    failed: int = 0
+    skipped: int = 0
+    duration: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self.users / self.duration if self.duration else 0.0
+
+
+def last_grade_time(user) -> float | None:
+    dates = [lesson['lesson_date'] for lesson in user.last_marks.get('lessons', [])]
+    if not dates:
+        return None
+    return datetime.strptime(max(dates), '%Y-%m-%d').timestamp()
+
+
+class PollSchedule:
+    def __init__(self, school: float = 60, evening: float = 300, weekend: float = 900, night: float = 1800,
+                 recent: float = 30, recent_window: float = 1800,
+                 inactive_after: float = 14 * 86400, inactive_factor: float = 3, max_interval: float = 3600):
+        self.school = school
+        self.evening = evening
+        self.weekend = weekend
+        self.night = night
+        self.recent = recent
+        self.recent_window = recent_window
+        self.inactive_after = inactive_after
+        self.inactive_factor = inactive_factor
+        self.max_interval = max_interval
+        self.last_change: dict[int, float] = {}
+        self._heap: list[tuple[float, int]] = []
+        self._due: dict[int, float] = {}
+        self._members: set[int] = set()
+
+    def __len__(self):
+        return len(self._members)
+
+    def base_interval(self, now: datetime) -> float:
+        if now.hour >= 22 or now.hour < 7:
+            return self.night
+        if now.weekday() >= 5:
+            return self.weekend
+        if 8 <= now.hour < 17:
+            return self.school
+        return self.evening
+
+    def interval(self, user_id: int, now: float | None = None) -> float:
+        now = now or time.time()
+        interval = self.base_interval(datetime.fromtimestamp(now))
+        last_change = self.last_change.get(user_id)
+        if last_change is not None and now - last_change < self.recent_window:
+            return min(interval, self.recent)
+        if last_change is None or now - last_change > self.inactive_after:
+            interval *= self.inactive_factor
+        return min(interval, self.max_interval)
+
+    def _push(self, user_id: int, due: float):
+        self._due[user_id] = due
+        heapq.heappush(self._heap, (due, user_id))
+
+    def add(self, user_id: int, last_change: float | None = None):
+        if user_id in self._members:
+            return
+        self._members.add(user_id)
+        if last_change is not None:
+            self.last_change[user_id] = last_change
+        # Новые пользователи (и все при старте) размазываются по первой минуте
+        self._push(user_id, time.time() + random.random() * min(self.interval(user_id), 60))
+
+    def remove(self, user_id: int):
+        self._members.discard(user_id)
+        self._due.pop(user_id, None)
+        self.last_change.pop(user_id, None)
+
+    def sync(self, users: dict):
+        for user_id in self._members - users.keys():
+            self.remove(user_id)
+        for user_id, user in users.items():
+            if user_id not in self._members:
+                self.add(user_id, last_grade_time(user))
+
+    def reschedule(self, user_id: int, changed: bool = False):
+        if user_id not in self._members:
+            return
+        now = time.time()
+        if changed:
+            self.last_change[user_id] = now
+        self._push(user_id, now + self.interval(user_id, now))
+
+    def postpone(self, user_id: int, delay: float):
+        if user_id in self._members:
+            self._push(user_id, time.time() + delay)
+
+    def pop_due(self) -> list[int]:
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            at, user_id = heapq.heappop(self._heap)
+            if self._due.get(user_id) == at:
+                del self._due[user_id]
+                due.append(user_id)
+        return due
+
+    def seconds_until_next(self) -> float:
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return float('inf')
+        return max(self._heap[0][0] - time.time(), 0)
+
+
+class GradePoller:
+    def __init__(self, handler: Callable[..., Awaitable[Any]], workers: int = 20,
+                 circuit: CircuitBreaker | None = None, flush_writes: Callable[[], Awaitable[Any]] | None = None,
+                 refresh_user: Callable[[Any, Any], None] | None = None):
+        if workers < 1:
+            raise ValueError("Количество воркеров должно быть больше нуля")
+        self.handler = handler
+        self.workers = workers
+        self.circuit = circuit
+        self.flush_writes = flush_writes
+        self.refresh_user = refresh_user
+        self.stats = CycleStats()
+
+    def _circuit_open(self) -> bool:
+        return self.circuit is not None and self.circuit.is_open
+
+    def _merge_users(self, users: dict, loaded: list) -> dict:
+        merged = {}
+        for user in loaded:
+            current = users.get(user.id)
+            if current is None:
+                merged[user.id] = user
+                continue
+            # Старый экземпляр может стоять в очереди или опрашиваться прямо сейчас: после
+            # подмены его результат (last_marks, курсор) потерялся бы для следующего опроса
+            # и та же оценка пришла бы повторно. Поэтому он остаётся, а из БД берутся
+            # только данные авторизации
+            if self.refresh_user is not None:
+                self.refresh_user(current, user)
+            merged[user.id] = current
+        return merged
+
+    async def _scheduled_worker(self, queue: asyncio.Queue, schedule: PollSchedule,
+                                rate_limiter: TokenBucket | None):
+        while True:
+            user = await queue.get()
+            changes = None
+            shed = False
+            started = time.perf_counter()
+            try:
+                if rate_limiter is not None:
+                    await rate_limiter.acquire()
+                started = time.perf_counter()
+                changes = await self.handler(user)
+                poll_users_total.inc(result='ok')
+            except CircuitOpenError:
+                shed = True
+                self.stats.skipped += 1
+                poll_users_total.inc(result='skipped')
+            except Exception as e:
+                self.stats.failed += 1
+                poll_users_total.inc(result='error')
+                logging.exception(f"{user.id} | Ошибка опроса: {e}. Продолжаем работу")
+            finally:
+                poll_user_seconds.observe(time.perf_counter() - started)
+                self.stats.users += 1
+                if shed:
+                    # Пользователь не опрошен — вернётся в очередь, как только NZ оживёт
+                    schedule.postpone(user.id, max(self.circuit.retry_after() if self.circuit else 0, 5))
+                else:
+                    schedule.reschedule(user.id, changed=bool(changes))
+                queue.task_done()
+
+    async def run_scheduled(self, schedule: PollSchedule, load_users: Callable[[], Awaitable[list]],
+                            rate_limiter: TokenBucket | None = None, sync_interval: float = 60):
+        queue = asyncio.Queue(maxsize=self.workers)
+        workers = [
+            asyncio.create_task(self._scheduled_worker(queue, schedule, rate_limiter))
+            for _ in range(self.workers)
+        ]
+        users: dict = {}
+        synced_at = 0.0
+        poll_scheduled_users.set_function(lambda: len(schedule))
+        try:
+            while True:
+                now = time.monotonic()
+                if now - synced_at >= sync_interval:
+                    if synced_at:
+                        stats = self.stats
+                        stats.duration = now - synced_at
+                        poll_cycle_seconds.observe(stats.duration)
+                        logging.info(
+                            f'Опрос за {stats.duration:.0f}с | опрошено: {stats.users} из {len(users)} '
+                            f'| ошибок: {stats.failed} | пропущено: {stats.skipped} | {stats.throughput:.1f} польз/с'
+                        )
+                        self.stats = CycleStats()
+                    synced_at = now
+                    try:
+                        if self.flush_writes is not None:
+                            # Иначе свежие объекты из БД не увидят ещё не записанные изменения
+                            await self.flush_writes()
+                        users = self._merge_users(users, await load_users())
+                        schedule.sync(users)
+                    except Exception as e:
+                        # Опрос продолжается по старому списку, синхронизация повторится позже
+                        logging.exception(f'Не удалось обновить список пользователей: {e}')
+
+                if self._circuit_open():
+                    # Пока NZ недоступен, пользователи остаются в расписании просроченными
+                    # и разойдутся по воркерам сразу после восстановления
+                    await asyncio.sleep(min(max(self.circuit.retry_after(), 0.1), 1.0))
+                    continue
+
+                for user_id in schedule.pop_due():
+                    if user_id in users:
+                        await queue.put(users[user_id])
+
+                await asyncio.sleep(min(schedule.seconds_until_next(), 1.0))
+        finally:
+            for worker in workers:
+                worker.cancel()
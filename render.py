@@ -0,0 +1,144 @@
+import asyncio
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from babel.dates import format_date
+
+from metrics import render_seconds
+from tracing import add_span
+
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', 2))
+FONT = os.getenv('RENDER_FONT', 'DejaVuSans.ttf')
+FONT_BOLD = os.getenv('RENDER_FONT_BOLD', 'DejaVuSans-Bold.ttf')
+
+HEADER_COLOR = (232, 232, 232)
+INDEX_COLOR = (242, 242, 242)
+GRID_COLOR = (160, 160, 160)
+TEXT_COLOR = (0, 0, 0)
+
+_fonts: dict = {}
+_executor: ProcessPoolExecutor | None = None
+
+
+def _font(size: int, bold: bool = False):
+    from PIL import ImageFont
+
+    key = (size, bold)
+    if key not in _fonts:
+        try:
+            _fonts[key] = ImageFont.truetype(FONT_BOLD if bold else FONT, size)
+        except OSError:
+            _fonts[key] = ImageFont.load_default(size)
+    return _fonts[key]
+
+
+def _text_width(draw, text: str, font) -> int:
+    return int(draw.textlength(text, font=font))
+
+
+def render_table(fio: str, mig: dict, month: str | None = None, scale: int = 2) -> bytes | None:
+    if not mig or not mig.get('rows'):
+        return None
+
+    # Pillow импортируется лениво: он нужен только воркерам рендера
+    from PIL import Image, ImageDraw
+
+    # Таблица уже хранится построчно (grades.update_matrix) — только подписи дат
+    subjects, dates, rows = mig['subjects'], mig['dates'], mig['rows']
+    labels = [date[8:10] + '.' + date[5:7] if len(date) == 10 else date for date in dates]
+
+    font = _font(11 * scale)
+    bold = _font(11 * scale, bold=True)
+    title = _font(15 * scale, bold=True)
+    padding = 6 * scale
+    row_height = 22 * scale
+
+    measure = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    index_width = max(_text_width(measure, subject, bold) for subject in subjects) + padding * 2
+    column_widths = [
+        max([_text_width(measure, label, bold)] + [_text_width(measure, row[i], font) for row in rows]) + padding * 2
+        for i, label in enumerate(labels)
+    ]
+
+    title_height = 30 * scale
+    width = index_width + sum(column_widths) + padding * 2
+    height = title_height + row_height * (len(rows) + 1) + padding * 2
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+
+    month = month or format_date(datetime.strptime(mig['month'], '%Y-%m'), 'LLLL', locale='ru_RU').title()
+    draw.text((padding, padding), fio or '', font=title, fill=TEXT_COLOR)
+    draw.text((width - padding - _text_width(draw, month, title), padding), month, font=title, fill=TEXT_COLOR)
+
+    top = padding + title_height
+    left = padding
+    draw.rectangle((left + index_width, top, width - padding, top + row_height), fill=HEADER_COLOR)
+    draw.rectangle((left, top + row_height, left + index_width, top + row_height * (len(rows) + 1)), fill=INDEX_COLOR)
+
+    x = left + index_width
+    for label, column_width in zip(labels, column_widths):
+        draw.text((x + column_width / 2, top + row_height / 2), label, font=bold, fill=TEXT_COLOR, anchor='mm')
+        x += column_width
+
+    for row_number, (subject, row) in enumerate(zip(subjects, rows), start=1):
+        y = top + row_height * row_number
+        draw.text((left + padding, y + row_height / 2), subject, font=bold, fill=TEXT_COLOR, anchor='lm')
+        x = left + index_width
+        for value, column_width in zip(row, column_widths):
+            if value:
+                draw.text((x + column_width / 2, y + row_height / 2), value, font=font, fill=TEXT_COLOR, anchor='mm')
+            x += column_width
+
+    bottom = top + row_height * (len(rows) + 1)
+    for row_number in range(len(rows) + 2):
+        y = top + row_height * row_number
+        draw.line((left if row_number else left + index_width, y, width - padding, y), fill=GRID_COLOR, width=1)
+    x = left
+    for column_width in [index_width] + column_widths:
+        draw.line((x, top if x != left else top + row_height, x, bottom), fill=GRID_COLOR, width=1)
+        x += column_width
+    draw.line((x, top, x, bottom), fill=GRID_COLOR, width=1)
+
+    buf = io.BytesIO()
+    image.save(buf, format='PNG', optimize=False)
+    return buf.getvalue()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+    return _executor
+
+
+async def render_performance(fio: str, mig: dict) -> bytes | None:
+    if not mig or not mig.get('rows'):
+        return None
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_get_executor(), render_table, fio, mig)
+    finally:
+        render_seconds.observe(time.perf_counter() - started)
+        add_span('render', time.perf_counter() - started)
+
+
+def _noop():
+    return None
+
+
+async def warmup():
+    # Поднимает процессы пула заранее, чтобы первый запрос успеваемости не ждал их запуска
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+    await asyncio.gather(*(loop.run_in_executor(executor, _noop) for _ in range(RENDER_WORKERS)))
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
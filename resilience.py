@@ -0,0 +1,99 @@
+import random
+import time
+from dataclasses import dataclass
+
+from logger import logging
+
+# Ответы, после которых запрос имеет смысл повторить и которые говорят о проблемах
+# на стороне NZ, а не конкретного пользователя (401 и 4xx в их число не входят)
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 5.0
+
+    def delay(self, attempt: int) -> float:
+        # Full jitter: повторы разных пользователей не приходят в NZ одной волной
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_threshold: int = 10, reset_timeout: float = 30,
+                 max_reset_timeout: float = 300):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._timeout = reset_timeout
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self._timeout:
+            self._state = self.HALF_OPEN
+            self._probing = False
+        return self._state
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
+
+    def state_value(self) -> int:
+        return self.STATE_VALUES[self.state]
+
+    def retry_after(self) -> float:
+        if self.state != self.OPEN:
+            return 0.0
+        return max(self._opened_at + self._timeout - time.monotonic(), 0.0)
+
+    def before_call(self):
+        state = self.state
+        if state == self.OPEN:
+            raise CircuitOpenError(f'{self.name} недоступен, повтор через {self.retry_after():.0f}с')
+        if state == self.HALF_OPEN:
+            # После паузы в NZ уходит один пробный запрос, остальные отбиваются сразу
+            if self._probing:
+                raise CircuitOpenError(f'{self.name} недоступен, идёт пробный запрос')
+            self._probing = True
+
+    def release(self):
+        # Запрос прерван не по вине NZ (например, отменён) — пробу можно повторить
+        self._probing = False
+
+    def record_success(self):
+        if self._state != self.CLOSED:
+            logging.info(f'{self.name} снова отвечает, запросы возобновлены')
+        self._state = self.CLOSED
+        self._failures = 0
+        self._timeout = self.reset_timeout
+        self._probing = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._state == self.HALF_OPEN:
+            # Пробный запрос не прошёл — пауза удваивается
+            self._timeout = min(self._timeout * 2, self.max_reset_timeout)
+            self._open()
+        elif self._state == self.CLOSED and self._failures >= self.failure_threshold:
+            self._open()
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probing = False
+        logging.warning(f'{self.name}: {self._failures} ошибок подряд, запросы приостановлены на {self._timeout:.0f}с')
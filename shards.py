@@ -0,0 +1,141 @@
+import asyncio
+import math
+import os
+import socket
+import time
+
+from database import acquire_lease, db_call, lease_owners, release_lease
+from logger import logging
+
+
+class LeaseCoordinator:
+    def __init__(self, owner: str | None = None, ttl: float = 30):
+        self.owner = owner or os.getenv('INSTANCE_ID') or f'{socket.gethostname()}:{os.getpid()}'
+        self.ttl = ttl
+        self._held: dict[str, float] = {}
+
+    def holds(self, name: str) -> bool:
+        # Локальный срок чуть короче серверного: работу прекращаем раньше,
+        # чем лизу сможет забрать другой процесс
+        deadline = self._held.get(name)
+        return deadline is not None and time.monotonic() < deadline
+
+    async def _acquire(self, name: str, grace: float = 0) -> float | None:
+        started = time.monotonic()
+        previous = await db_call(acquire_lease, name, self.owner, self.ttl, grace)
+        if previous is not None:
+            self._held[name] = started + self.ttl * 0.8
+        else:
+            self._held.pop(name, None)
+        return previous
+
+    async def acquire(self, name: str, grace: float = 0) -> bool:
+        return await self._acquire(name, grace) is not None
+
+    async def release(self, name: str):
+        self._held.pop(name, None)
+        await db_call(release_lease, name, self.owner)
+
+    async def wait_for(self, name: str):
+        while not await self.acquire(name):
+            logging.info(f'{self.owner} | Лиза {name} занята, ожидание')
+            await asyncio.sleep(self.ttl / 3)
+
+    async def keep(self, name: str) -> None:
+        # Возвращается, только когда лиза потеряна
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if not await self.acquire(name):
+                    logging.critical(f'{self.owner} | Лиза {name} потеряна')
+                    return
+            except Exception as e:
+                logging.error(f'{self.owner} | Ошибка продления лизы {name}: {e}')
+                if not self.holds(name):
+                    return
+
+
+class ShardCoordinator(LeaseCoordinator):
+    def __init__(self, shard_count: int, owner: str | None = None, ttl: float = 30,
+                 handoff_grace: float | None = None):
+        super().__init__(owner, ttl)
+        self.shard_count = shard_count
+        self.target = shard_count
+        # Прежний владелец шарда может ещё дописывать начатые опросы (с повторами до ~30с)
+        # и сбрасывать пачку записей, поэтому новый начинает опрос не раньше handoff_grace
+        # после того, как лиза освободилась
+        self.handoff_grace = handoff_grace if handoff_grace is not None else ttl * 1.5
+        self._ready_at: dict[int, float] = {}
+
+    @staticmethod
+    def _name(shard: int) -> str:
+        return f'shard:{shard}'
+
+    @property
+    def _worker_name(self) -> str:
+        return f'worker:{self.owner}'
+
+    def shard_of(self, user_id: int) -> int:
+        return user_id % self.shard_count
+
+    def _held_shards(self) -> set[int]:
+        return {shard for shard in range(self.shard_count) if self.holds(self._name(shard))}
+
+    @property
+    def owned(self) -> set[int]:
+        now = time.monotonic()
+        return {shard for shard in self._held_shards() if self._ready_at.get(shard, 0) <= now}
+
+    def owns(self, user_id: int) -> bool:
+        shard = self.shard_of(user_id)
+        return self.holds(self._name(shard)) and self._ready_at.get(shard, 0) <= time.monotonic()
+
+    async def _claim(self, shard: int, grace: float = 0) -> bool:
+        previous = await self._acquire(self._name(shard), grace)
+        if previous is None:
+            return False
+        wait = self.handoff_grace - (time.time() - previous) if previous else 0
+        self._ready_at[shard] = time.monotonic() + max(wait, 0)
+        return True
+
+    async def rebalance(self):
+        # Целевое число шардов считается по живым воркерам (их лизы worker:*),
+        # а не по заданному числу: после падения воркера остальные делят его шарды
+        await self.acquire(self._worker_name)
+        live = set(await db_call(lease_owners, 'worker:')) | {self.owner}
+        counts = await db_call(lease_owners, 'shard:')
+        self.target = math.ceil(self.shard_count / len(live))
+
+        owned = set()
+        for shard in self._held_shards():
+            if await self.acquire(self._name(shard)):
+                owned.add(shard)
+            else:
+                self._ready_at.pop(shard, None)
+
+        # Лишний шард отдаётся, только если есть живой воркер, которому его не хватает
+        released = None
+        if len(owned) > self.target and any(counts.get(peer, 0) < self.target for peer in live - {self.owner}):
+            released = max(owned)
+            owned.discard(released)
+            self._ready_at.pop(released, None)
+            await self.release(self._name(released))
+
+        for shard in range(self.shard_count):
+            if len(owned) >= self.target:
+                break
+            if shard not in owned and await self._claim(shard):
+                owned.add(shard)
+
+        # Шарды упавших воркеров, которые никто не забрал за ttl, берёт любой
+        for shard in range(self.shard_count):
+            if shard not in owned and shard != released and await self._claim(shard, grace=self.ttl):
+                owned.add(shard)
+
+    async def run(self):
+        while True:
+            try:
+                await self.rebalance()
+            except Exception as e:
+                logging.error(f'{self.owner} | Ошибка распределения шардов: {e}')
+            await asyncio.sleep(self.ttl / 3)
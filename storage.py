@@ -0,0 +1,104 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+from database import db_call, delete_fsm_states, load_fsm_states, save_fsm_state
+from logger import logging
+
+
+class TTLStorage(BaseStorage):
+    # Стандартный MemoryStorage держит записи вечно и создаёт их даже на чтение,
+    # поэтому брошенные на полпути авторизации копятся. Здесь запись живёт ttl
+    # секунд с последнего изменения, а сверх max_size вытесняются самые старые
+    def __init__(self, ttl: float = 3600, max_size: int = 10000, persist: bool = False,
+                 private_states: tuple[str, ...] = ()):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.persist = persist
+        # Состояния с этими префиксами (например, ввод логина и пароля) в SQLite не пишутся
+        self.private_states = private_states
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True,
+                                             with_destiny=True)
+        self._records: OrderedDict[str, tuple[str | None, dict, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _get(self, key: StorageKey) -> tuple[str | None, dict, float] | None:
+        name = self.key_builder.build(key)
+        record = self._records.get(name)
+        if record is None:
+            return None
+        if record[2] <= time.time():
+            del self._records[name]
+            return None
+        return record
+
+    async def _put(self, key: StorageKey, state: str | None, data: dict):
+        name = self.key_builder.build(key)
+        if state is None and not data:
+            if self._records.pop(name, None) is not None and self.persist:
+                await db_call(delete_fsm_states, [name])
+            return
+
+        expires_at = time.time() + self.ttl
+        self._records[name] = (state, data, expires_at)
+        self._records.move_to_end(name)
+        evicted = []
+        while len(self._records) > self.max_size:
+            evicted.append(self._records.popitem(last=False)[0])
+        if self.persist:
+            if state is not None and state.startswith(self.private_states):
+                await db_call(delete_fsm_states, [name])
+            else:
+                await db_call(save_fsm_state, name, state, data, expires_at)
+            if evicted:
+                await db_call(delete_fsm_states, evicted)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._get(key)
+        state = state.state if isinstance(state, State) else state
+        await self._put(key, state, record[1] if record else {})
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        record = self._get(key)
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        record = self._get(key)
+        await self._put(key, record[0] if record else None, dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        record = self._get(key)
+        return dict(record[1]) if record else {}
+
+    def purge(self) -> list[str]:
+        now = time.time()
+        expired = [name for name, record in self._records.items() if record[2] <= now]
+        for name in expired:
+            del self._records[name]
+        return expired
+
+    async def load(self):
+        if not self.persist:
+            return
+        rows = await db_call(load_fsm_states)
+        for row in rows[-self.max_size:]:
+            self._records[row.key] = (row.state, row.data, row.expires_at)
+        logging.info(f'Восстановлено состояний FSM: {len(self._records)}')
+
+    async def run(self, interval: float = 300):
+        while True:
+            await asyncio.sleep(interval)
+            expired = self.purge()
+            if expired and self.persist:
+                await db_call(delete_fsm_states, expired)
+            if expired:
+                logging.debug(f'Удалено просроченных состояний FSM: {len(expired)}')
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,86 @@
+import asyncio
+import heapq
+import random
+import time
+from datetime import timedelta
+from typing import Any, Awaitable, Callable
+
+from logger import logging
+from metrics import token_refresh_total
+
+
+class TokenManager:
+    def __init__(self, refresh_window: timedelta = timedelta(days=25), margin: timedelta = timedelta(days=1)):
+        # Токен обновляется в случайный момент между (expires - refresh_window)
+        # и (expires - margin), чтобы логины не собирались в один момент.
+        # Обязательное обновление перед запросом — только внутри margin
+        self.refresh_window = refresh_window.total_seconds()
+        self.margin = margin.total_seconds()
+        self._inflight: dict[int, asyncio.Task] = {}
+        self._heap: list[tuple[float, int]] = []
+        self._scheduled: dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+
+    def needs_refresh(self, token_expired: int | None) -> bool:
+        return not token_expired or token_expired <= time.time() + self.margin
+
+    async def refresh(self, user_id: int, login: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(login())
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+            task.add_done_callback(lambda t: token_refresh_total.inc(
+                result='error' if t.cancelled() or t.exception() else 'ok'))
+        return await asyncio.shield(task)
+
+    def schedule(self, user_id: int, token_expired: int | None):
+        if not token_expired:
+            return
+        now = time.time()
+        start = max(token_expired - self.refresh_window, now)
+        end = max(token_expired - self.margin, start)
+        refresh_at = start + random.random() * (end - start)
+        self._scheduled[user_id] = refresh_at
+        heapq.heappush(self._heap, (refresh_at, user_id))
+        self._wakeup.set()
+
+    def forget(self, user_id: int):
+        self._scheduled.pop(user_id, None)
+
+    def _retry(self, user_id: int, delay: float = 3600):
+        refresh_at = time.time() + delay
+        self._scheduled[user_id] = refresh_at
+        heapq.heappush(self._heap, (refresh_at, user_id))
+
+    def _pop_due(self) -> int | None:
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            refresh_at, user_id = heapq.heappop(self._heap)
+            if self._scheduled.get(user_id) == refresh_at:
+                del self._scheduled[user_id]
+                return user_id
+        return None
+
+    async def run(self, refresh_user: Callable[[int], Awaitable[Any]], max_sleep: float = 60):
+        while True:
+            user_id = self._pop_due()
+            if user_id is not None:
+                try:
+                    await refresh_user(user_id)
+                except Exception as e:
+                    logging.error(f"{user_id} | Ошибка планового обновления токена: {e}")
+                    self._retry(user_id)
+                continue
+
+            delay = max_sleep
+            if self._heap:
+                delay = min(max(self._heap[0][0] - time.time(), 0), max_sleep)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+token_manager = TokenManager()
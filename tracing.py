@@ -0,0 +1,104 @@
+import cProfile
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import TelegramObject
+
+from logger import logging
+from metrics import handler_seconds, handler_span_seconds
+
+
+class Trace:
+    __slots__ = ('handler', 'started', 'spans')
+
+    def __init__(self):
+        self.handler = 'unhandled'
+        self.started = time.perf_counter()
+        self.spans: dict[str, float] = {}
+
+    def add(self, name: str, duration: float):
+        self.spans[name] = self.spans.get(name, 0.0) + duration
+
+
+_current: ContextVar[Trace | None] = ContextVar('trace', default=None)
+
+
+def add_span(name: str, duration: float):
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, duration)
+
+
+@contextmanager
+def span(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, time.perf_counter() - started)
+
+
+class TelegramSpanMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        with span('telegram'):
+            return await make_request(bot, method)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        trace = _current.get()
+        handler_object = data.get('handler')
+        if trace is not None and handler_object is not None:
+            trace.handler = getattr(handler_object.callback, '__name__', 'unknown')
+        return await handler(event, data)
+
+
+class TimingMiddleware(BaseMiddleware):
+    def __init__(self, slow_threshold: float = 1.0, profile_rate: float = 0.0, profile_dir: str = 'profiles'):
+        self.slow_threshold = slow_threshold
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self._profiling = False
+
+    async def __call__(self, handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: dict[str, Any]) -> Any:
+        trace = Trace()
+        token = _current.set(trace)
+        # cProfile профилирует весь поток, включая чужие задачи event loop,
+        # поэтому одновременно снимается не больше одного профиля
+        profiler = None
+        if self.profile_rate and not self._profiling and random.random() < self.profile_rate:
+            self._profiling = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            return await handler(event, data)
+        finally:
+            _current.reset(token)
+            total = time.perf_counter() - trace.started
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                self._dump(profiler, trace)
+            self._record(trace, total)
+
+    def _record(self, trace: Trace, total: float):
+        handler_seconds.observe(total, handler=trace.handler)
+        for name, duration in trace.spans.items():
+            handler_span_seconds.observe(duration, handler=trace.handler, span=name)
+        if total >= self.slow_threshold:
+            spans = ', '.join(f'{name} {duration * 1000:.0f}мс' for name, duration in trace.spans.items())
+            logging.warning(f'Медленный апдейт {trace.handler}: {total * 1000:.0f}мс ({spans or "без спанов"})')
+
+    def _dump(self, profiler: cProfile.Profile, trace: Trace):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f'{trace.handler}-{int(time.time() * 1000)}.prof')
+        profiler.dump_stats(path)
+        logging.debug(f'Профиль {trace.handler} сохранён: {path}')